@@ -26,7 +26,7 @@ __version__ = get_version()
 
 # TODO: This should be a function that takes the model version, since it
 # may change over time.
-VOCAB_TABLES = (
+VOCAB_TABLES = frozenset((
     'vocabulary',
     'concept',
     'concept_ancestor',
@@ -38,7 +38,7 @@ VOCAB_TABLES = (
     'relationship',
     'source_to_concept_map',
     'cohort_definition'
-)
+))
 
 # TODO: Generate this map dynamically at runtime from the distinct
 # fact_relationship.domain_concept_id_{1,2} values and the domain table.
@@ -2,10 +2,11 @@ import collections
 import logging
 import multiprocessing
 import psycopg2
+import psycopg2.extensions
 import uuid
 import threading
 
-from pedsnetdcc.dict_logging import DictQueueHandler
+from pedsnetdcc.dict_logging import BatchingDictQueueHandler, make_record
 from pedsnetdcc.utils import get_conn_info_dict, combine_dicts
 
 logger = logging.getLogger(__name__)
@@ -28,25 +29,47 @@ class Statement(object):
     the calling function looks for and responds to any errors or missing
     data.**
 
+    If `itersize` is given, the statement must be a single query returning
+    rows. It is then run through a server-side (named) cursor and the rows are
+    fetched `itersize` at a time, so that large results are never buffered in
+    full by libpq. If a `sink` is given too, each batch is passed to it as it
+    is fetched instead of being collected in the data attribute, so the rows
+    are never all held in memory. A sink has to be picklable for the
+    statement to be executed in parallel.
+
+    If `params` is given, it is passed to the dbapi cursor along with the sql,
+    so values are bound with %s or %(name)s placeholders instead of being
+    formatted into the sql text. Identifiers still have to be formatted in.
+
     :raises RuntimeError: if setting the id_ attribute is attempted
     """
 
     # Keep a class constant reference to the module-level logger.
     logger = logger
 
-    def __init__(self, sql, msg='executing SQL', id_=None):
+    def __init__(self, sql, msg='executing SQL', id_=None, itersize=None,
+                 params=None, sink=None):
         """Populate defaults on a new Statement object.
 
         If msg is not passed, a default 'executing SQL' message is used. If id_
         is not passed, a uuid is generated for the Statement.
 
-        :param str sql: the sql statement
-        :param str msg: a message describing the purpose of the sql
-        :param id_:     the unique identifer of the Statement
+        :param str sql:      the sql statement
+        :param str msg:      a message describing the purpose of the sql
+        :param id_:          the unique identifer of the Statement
+        :param int itersize: fetch rows in batches of this size through a
+                             server-side cursor (None to fetch all at once)
+        :param params:       sequence or mapping of values to bind to the sql
+                             placeholders (None if the sql has none)
+        :param sink:         callable passed each list of rows fetched when
+                             itersize is set (None to collect them in data)
         """
         self.sql = sql
+        self.params = params
         self.msg = msg
         self._id_ = id_ or uuid.uuid4()
+        self.itersize = itersize
+        self.sink = sink
         self.data = None
         self.fields = []
         self.rowcount = None
@@ -97,7 +120,8 @@ class Statement(object):
         """Setup and return a logger for the instance.
 
         If not logq, this is just the module level logger via self.logger. If
-        logq, this is a QueueHandler logger for parallel process logging.
+        logq, this is a QueueHandler logger for parallel process logging, which
+        batches records until `_flush_logger` is called.
 
         :param Queue logq: the queue to log on or None
         :returns:          the logger to use
@@ -113,10 +137,18 @@ class Statement(object):
             local_logger = logging.getLogger(str(self.id_))
             local_logger.setLevel(logging.DEBUG)
             if not local_logger.handlers:
-                qh = DictQueueHandler(logq)
+                qh = BatchingDictQueueHandler(logq)
                 local_logger.addHandler(qh)
             return local_logger
 
+    def _flush_logger(self, local_logger):
+        """Flush any log records batched by the handlers of local_logger.
+
+        :param logging.Logger local_logger: the logger from `_get_logger`
+        """
+        for handler in local_logger.handlers:
+            handler.flush()
+
     def execute(self, conn_str, resq=None, logq=None):
         """Execute the sql statement against a database. Usable in parallel.
 
@@ -138,7 +170,6 @@ class Statement(object):
         """
 
         local_logger = self._get_logger(logq)
-        conn_info = get_conn_info_dict(conn_str)
 
         conn = None
 
@@ -152,10 +183,14 @@ class Statement(object):
         # connection error.
         except Exception as err:
             self.err = err
-            msg_dict = combine_dicts({'msg': 'connection error while {0}'.
-                                      format(self.msg), 'err': str(err),
-                                      'id': self.id_}, conn_info)
-            local_logger.debug(msg_dict)
+            if local_logger.isEnabledFor(logging.DEBUG):
+                msg_dict = combine_dicts({'msg': 'connection error while {0}'.
+                                          format(self.msg), 'err': str(err),
+                                          'id': self.id_},
+                                         get_conn_info_dict(conn_str))
+                local_logger.debug(msg_dict)
+            if logq:
+                self._flush_logger(local_logger)
 
             # If there is a connection error, `execute_on_conn` will not run
             # and self needs to be put on the queue.
@@ -175,16 +210,19 @@ class Statement(object):
         statement is executed in that cursor. The statement sql, msg, id_ and
         conn_info are logged at debug level. The rowcount or None is placed in
         self.rowcount. The field names are stored in the self.fields list. The
-        data is fetched using cursor.fetchall() and stored in self.data. If no
-        results exist, the error is caught and None is stored instead.
+        data is fetched using cursor.fetchall() (or in batches of self.itersize
+        from a server-side cursor, passed to self.sink if given) and stored in
+        self.data. If no results exist, the error is caught and None is stored
+        instead.
 
         If an error occurs while executing the statement, it is caught and
         stored in self.err and 'database error while `msg`', str(err), id_ and
         conn_info are logged at debug level. The error is not reraised. The
         Statement object itself is returned.
 
-        If logq is given, a DictQueueHandler is created and the log messages
-        are passed through that instead of the module level logger. If resq is
+        If logq is given, a BatchingDictQueueHandler is created and the log
+        messages are passed through that instead of the module level logger,
+        being flushed onto logq once the statement is done. If resq is
         given, the Statement object is put onto that queue after processing.
 
         Resets state on every call to make re-execution produce sensible state.
@@ -202,49 +240,199 @@ class Statement(object):
         self.rowcount = None
         self.err = None
 
+        # Only build the debug messages (which carry the whole sql) when
+        # they will be logged.
         local_logger = self._get_logger(logq)
-        conn_info = get_conn_info_dict(conn.dsn)
+        debug = local_logger.isEnabledFor(logging.DEBUG)
+        conn_info = get_conn_info_dict(conn.dsn) if debug else None
+
+        # A server-side cursor only lives as long as its transaction. Rather
+        # than declaring it WITH HOLD on an autocommit connection, which makes
+        # the server materialize the whole result up front, it is run in a
+        # transaction of its own.
+        autocommit = conn.autocommit
+        in_transaction = bool(self.itersize) and autocommit
 
         try:
-            with conn.cursor() as cursor:
+            if in_transaction:
+                conn.autocommit = False
 
-                # Execute the query.
-                msg_dict = combine_dicts({'msg': self.msg, 'sql': self.sql,
-                                          'id_': self.id_}, conn_info)
-                local_logger.debug(msg_dict)
+            with self._cursor(conn) as cursor:
 
-                cursor.execute(self.sql)
+                # Execute the query.
+                if debug:
+                    msg_dict = combine_dicts({'msg': self.msg,
+                                              'sql': self.sql,
+                                              'id_': self.id_}, conn_info)
+                    if self.params is not None:
+                        msg_dict['params'] = self.params
+                    local_logger.debug(msg_dict)
 
-                # Get the effected row count.
-                if cursor.rowcount not in [-1, None]:
-                    self.rowcount = cursor.rowcount
+                cursor.execute(self.sql, self.params)
 
-                # Get the result field names.
-                if cursor.description:
-                    for field in cursor.description:
-                        self.fields.append(field[0])
+                if self.itersize:
+                    self._fetch_batches(cursor)
+                else:
+                    self._fetch_all(cursor)
 
-                # Retrieve the data or, if none, leave data as None.
-                try:
-                    self.data = cursor.fetchall()
-                except psycopg2.ProgrammingError as e:
-                    if e.args[0] == 'no results to fetch':
-                        pass
-                    else:
-                        raise
+            if in_transaction:
+                conn.commit()
 
         except Exception as err:
             self.err = err
-            msg_dict = combine_dicts({'msg': 'database error while {0}'.
-                                      format(self.msg), 'err': str(err),
-                                      'id': self.id_}, conn_info)
-            local_logger.debug(msg_dict)
+            if in_transaction and not conn.closed:
+                conn.rollback()
+            if debug:
+                msg_dict = combine_dicts({'msg': 'database error while {0}'.
+                                          format(self.msg), 'err': str(err),
+                                          'id': self.id_}, conn_info)
+                local_logger.debug(msg_dict)
+
+        finally:
+            if in_transaction and not conn.closed:
+                conn.autocommit = autocommit
+
+        if logq:
+            self._flush_logger(local_logger)
 
         if resq:
             resq.put(self)
 
         return self
 
+    def execute_copy_to(self, conn, fileobj, logq=None):
+        """Write the results of the sql query to a file as CSV using COPY.
+
+        The sql must be a single query returning rows. It is wrapped as `COPY
+        (sql) TO STDOUT WITH (FORMAT CSV, HEADER TRUE)` and run with
+        cursor.copy_expert, so the rows are streamed straight into fileobj
+        without being built into Python objects. self.data is left as None and
+        the number of rows copied is stored in self.rowcount.
+
+        Errors are handled as in `execute_on_conn`: stored in self.err and
+        logged at debug level, but not reraised.
+
+        :param conn:       dbapi connection object to the database
+        :param fileobj:    file-like object with a write method
+        :param Queue logq: queue to put log records onto
+        :returns:          the processed Statement object itself
+        :rtype:            Statement
+        """
+
+        # Re-initialize attributes in case this is a re-execution.
+        self.data = None
+        self.fields = []
+        self.rowcount = None
+        self.err = None
+
+        local_logger = self._get_logger(logq)
+        debug = local_logger.isEnabledFor(logging.DEBUG)
+        conn_info = get_conn_info_dict(conn.dsn) if debug else None
+
+        try:
+            with conn.cursor() as cursor:
+
+                # COPY can't take bind parameters, so bind them client side.
+                sql = self.sql
+                if self.params is not None:
+                    sql = cursor.mogrify(sql, self.params)
+                    if not isinstance(sql, str):
+                        sql = sql.decode(
+                            psycopg2.extensions.encodings[conn.encoding])
+                copy_sql = 'COPY ({0}) TO STDOUT WITH (FORMAT CSV, ' \
+                    'HEADER TRUE)'.format(sql.strip().rstrip(';'))
+
+                if debug:
+                    msg_dict = combine_dicts({'msg': self.msg,
+                                              'sql': copy_sql,
+                                              'id_': self.id_}, conn_info)
+                    local_logger.debug(msg_dict)
+
+                cursor.copy_expert(copy_sql, fileobj)
+
+                if cursor.rowcount not in [-1, None]:
+                    self.rowcount = cursor.rowcount
+
+        except Exception as err:
+            self.err = err
+            if debug:
+                msg_dict = combine_dicts({'msg': 'database error while {0}'.
+                                          format(self.msg), 'err': str(err),
+                                          'id': self.id_}, conn_info)
+                local_logger.debug(msg_dict)
+
+        if logq:
+            self._flush_logger(local_logger)
+
+        return self
+
+    def _cursor(self, conn):
+        """Return a cursor on conn, server-side if self.itersize is set.
+
+        The cursor has to be used within a transaction, see
+        `execute_on_conn`.
+
+        :param conn: dbapi connection object to the database
+        :returns:    a new cursor
+        """
+        if not self.itersize:
+            return conn.cursor()
+
+        name = 'pedsnetdcc_{0}'.format(uuid.uuid4().hex)
+        cursor = conn.cursor(name=name)
+        cursor.itersize = self.itersize
+        return cursor
+
+    def _fetch_all(self, cursor):
+        """Collect the rowcount, field names, and all rows from a cursor.
+
+        If the statement returned no results, data is left as None.
+
+        :param cursor: an executed cursor
+        """
+        # Get the effected row count.
+        if cursor.rowcount not in [-1, None]:
+            self.rowcount = cursor.rowcount
+
+        # Get the result field names.
+        if cursor.description:
+            self.fields = [field[0] for field in cursor.description]
+
+        # Retrieve the data or, if none, leave data as None.
+        try:
+            self.data = cursor.fetchall()
+        except psycopg2.ProgrammingError as e:
+            if e.args[0] == 'no results to fetch':
+                pass
+            else:
+                raise
+
+    def _fetch_batches(self, cursor):
+        """Fetch all rows from a server-side cursor, itersize at a time.
+
+        Each batch is passed to self.sink if there is one, otherwise the rows
+        are collected in self.data. The field names are only available after
+        the first fetch from a server-side cursor, and the rowcount is the
+        number of rows fetched.
+
+        :param cursor: an executed server-side cursor
+        """
+        if self.sink is None:
+            self.data = []
+        self.rowcount = 0
+        while True:
+            rows = cursor.fetchmany(self.itersize)
+            if not rows:
+                break
+            self.rowcount += len(rows)
+            if self.sink is None:
+                self.data.extend(rows)
+            else:
+                self.sink(rows)
+
+        if cursor.description:
+            self.fields = [field[0] for field in cursor.description]
+
 
 class StatementSet(collections.MutableSet):
     """A set of statements that can be executed in parallel.
@@ -291,11 +479,12 @@ class StatementSet(collections.MutableSet):
         method with taskq, resq, and logq as task provisioning, result putting,
         and log record putting queues as arguments. Place all of the Statements
         in the set onto the task queue, start the `_logger_thread` module
-        method in a thread to receive log records on logq, and wait for all the
-        tasks on the task queue to finish. Stop all the workers, end the
-        logging thread, and collect the results by clearing the set and then
-        adding the now modified Statements on the result queue back into the
-        set. Return self.
+        method in a thread to receive log records on logq, start the
+        `_collector_thread` module method in a thread to receive the now
+        modified Statements from the result queue as they finish, and wait for
+        all the tasks on the task queue to finish. Stop all the workers, end the
+        logging and collector threads, and replace the members of the set with
+        the collected results. Return self.
 
         If taskq, resq, or logq are not given, fresh multiprocessing.Queues are
         used for resq and logq and a fresh multiprocessing.JoinableQueue is
@@ -344,6 +533,12 @@ class StatementSet(collections.MutableSet):
         logp = threading.Thread(target=_logger_thread, args=(logq,))
         logp.start()
 
+        # Start the collector thread to receive results as they are produced.
+        results = []
+        collector = threading.Thread(target=_collector_thread,
+                                     args=(resq, results))
+        collector.start()
+
         # Wait for all the work to be done.
         taskq.join()
 
@@ -357,13 +552,11 @@ class StatementSet(collections.MutableSet):
         logq.put(None)
         logp.join()
 
-        # Collect the results.
-        self.clear()
+        # End the collector thread and replace the members with the results.
         resq.put(None)
-        while True:
-            result = resq.get()
-            if result is None:
-                break
+        collector.join()
+        self.clear()
+        for result in results:
             self.add(result)
 
         return self
@@ -478,20 +671,46 @@ def _worker_process(conn_str, taskq, resq=None, logq=None):
         taskq.task_done()
 
 
+def _collector_thread(resq, results):
+    """Appends results from resq onto the results list.
+
+    Draining the result queue while the workers are running keeps workers
+    from blocking on a full queue when they exit. Stops when None is retrieved
+    from the queue. Only intended for internal use by the parallel_execute
+    function.
+
+    :param resq:    queue to get results from
+    :type resq:     queue.Queue
+    :param results: list to append results to
+    :type results:  list
+    """
+    while True:
+        result = resq.get()
+        if result is None:
+            break
+        results.append(result)
+
+
 def _logger_thread(logq):
     """Passes log records from logq on to the module-level logger.
 
     Because logger.handle (which handles already created log records)
     does not check the logger level, check it before calling that method.
     Stops when None is retrieved from the queue. Only intended for internal
-    use by the parallel_execute function.
+    use by the parallel_execute function. Records enqueued as attribute dicts
+    (see DictQueueHandler.prepare) are rebuilt with make_record, and
+    lists of records (see BatchingDictQueueHandler) are handled in order.
 
-    :param logq: queue to get log records from
+    :param logq: queue to get log records (or record dicts, or lists) from
     :type logq:  queue.Queue
     """
     while True:
-        record = logq.get()
-        if record is None:
+        item = logq.get()
+        if item is None:
             break
-        if logger.isEnabledFor(record.levelno):
-            logger.handle(record)
+        records = item if isinstance(item, list) else [item]
+        for record in records:
+            if isinstance(record, dict):
+                record = make_record(record)
+            if logger.isEnabledFor(record.levelno):
+                logger.handle(record)
@@ -1,7 +1,7 @@
-import collections
 import datetime
 import json
 import logging
+import threading
 import time
 
 # Python 2 compatibility
@@ -10,6 +10,49 @@ try:
 except ImportError:
     from logutils.queue import QueueHandler
 
+# Python 2 compatibility for the abstract collection types used by stringify.
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+
+# Use orjson for the json output format if it is installed.
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _dumps = json.dumps
+
+
+# Pack dict msgs for the log queue with msgpack if it is installed.
+try:
+    import msgpack
+
+    def _pack(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _unpack(data):
+        # Python 2 strs are packed as bin and must come back as raw bytes.
+        return msgpack.unpackb(data, raw=(str is bytes))
+except ImportError:
+    msgpack = None
+
+
+# Escape backslashes and double quotes in text_filter values with a
+# translation table where str.maketrans exists (Python 3), falling back to
+# str.replace on Python 2, where backslashes have to be escaped first.
+try:
+    _QUOTE_TRANS = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+    def _escape_quotes(value):
+        return value.translate(_QUOTE_TRANS)
+except AttributeError:
+    def _escape_quotes(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
 
 # Python 2/3 hack for stringify, below
 try:
@@ -18,14 +61,18 @@ except NameError:
     unicode = str
 
 
-nocolor = 0
 red = 31
 green = 32
 yellow = 33
 blue = 34
-gray = 37
 starttime = time.time()
 
+# The last (second, result) pairs of strtime and secs_since, whose results
+# only change once a second. Each pair is stored in a single assignment so
+# that threads never see a result paired with the wrong second.
+_strtime_cache = {'last': (None, '')}
+_secs_since_cache = {'last': (None, '')}
+
 
 def secs_since(starttime):
     """Return the (padded) number of whole seconds since `starttime`.
@@ -35,7 +82,14 @@ def secs_since(starttime):
     :returns:         number of seconds since starttime padded to 4 with 0s
     :rtype:           str
     """
-    return '{0:0>4}'.format(int(time.time() - starttime))
+    secs = int(time.time() - starttime)
+    last_secs, last_str = _secs_since_cache['last']
+    if secs == last_secs:
+        return last_str
+
+    out = '%04d' % secs
+    _secs_since_cache['last'] = (secs, out)
+    return out
 
 
 def strtime():
@@ -45,7 +99,11 @@ def strtime():
     :rtype:   str
     """
 
-    curr_time = time.time()
+    curr_time = int(time.time())
+    last_time, last_str = _strtime_cache['last']
+    if curr_time == last_time:
+        return last_str
+
     fmtd_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(curr_time))
 
     utc_offset = ((datetime.datetime.fromtimestamp(curr_time) -
@@ -54,25 +112,31 @@ def strtime():
     utc_hours = int(utc_offset // 3600)
     utc_mins = abs(int(utc_offset % 3600 // 60))
 
-    return '{0}{1:0=+3}:{2:0>2}'.format(fmtd_time, utc_hours, utc_mins)
+    out = '{0}{1:0=+3}:{2:0>2}'.format(fmtd_time, utc_hours, utc_mins)
+    _strtime_cache['last'] = (curr_time, out)
+    return out
+
+
+_LEVEL_COLORS = {logging.DEBUG: green, logging.WARNING: yellow,
+                 logging.ERROR: red, logging.CRITICAL: red}
 
 
 def levelcolor(level):
     """Return the terminal color number appropriate for the logging level.
 
+    Levels without a specific color, including INFO, are blue.
+
     :param int level: logging level in integer form
     :returns:         the SGR parameter number for foreground text color
     :rtype:           int
     """
+    return _LEVEL_COLORS.get(level, blue)
 
-    if level == logging.DEBUG:
-        return green
-    elif level == logging.WARNING:
-        return yellow
-    elif level in (logging.ERROR, logging.CRITICAL):
-        return red
-    else:
-        return blue
+
+# Prebuilt SGR color escapes for the standard levels, used by tty_filter.
+_TTY_CACHE = dict((level, '\x1b[{0}m'.format(levelcolor(level)))
+                  for level in (logging.DEBUG, logging.INFO, logging.WARNING,
+                                logging.ERROR, logging.CRITICAL))
 
 
 class DictLogFilter(object):
@@ -95,21 +159,31 @@ class DictLogFilter(object):
     data from the dict in 'key=val key=val' format.
     """
 
+    __slots__ = ('output', '_dispatch')
+
     def __init__(self, output=None):
         """Create a DictLogFilter object, setting the output format if given.
 
         :param output: the output format
         :type output:  None or str from ['json', 'text', or 'tty']
         :returns:      a new DictLogFilter object
-        :rtype:        Dic)LogFilter
+        :rtype:        DictLogFilter
         """
         self.output = output
 
+        # Choose the '*filter' method once rather than on every record.
+        if output == 'text':
+            self._dispatch = self.text_filter
+        elif output == 'tty':
+            self._dispatch = self.tty_filter
+        else:
+            self._dispatch = self.json_filter
+
     def filter(self, record):
         """Format the log record if record.msg is a dict.
 
-        Dispatch the record to appropriate '*filter' method depending on the
-        the value of self.output. json formatting is the default.
+        Dispatch the record to the appropriate '*filter' method, chosen at
+        creation from the value of self.output. json formatting is the default.
 
         :param record: a log record instance
         :type record:  logging.LogRecord
@@ -117,15 +191,8 @@ class DictLogFilter(object):
         :rtype:        bool
         """
 
-        if not isinstance(record.msg, dict):
-            return True
-
-        if self.output == 'text':
-            return self.text_filter(record)
-        elif self.output == 'tty':
-            return self.tty_filter(record)
-        else:
-            return self.json_filter(record)
+        return (self._dispatch(record) if isinstance(record.msg, dict)
+                else True)
 
     def json_filter(self, record):
         """Format the log record in json style.
@@ -135,15 +202,18 @@ class DictLogFilter(object):
         :returns:      always True to indicate the record should be handled
         :rtype:        bool
         """
-        # Add time and level entries.
-        record.msg['time'] = strtime()
-        record.msg['level'] = record.levelname.lower()
-
         # Ensure all keys and values are stringified to assist json.dumps.
-        record.msg = stringify(record.msg)
+        # Add time and level entries to a copy, leaving the caller's dict be;
+        # stringify only returns the same dict when it needed no changes.
+        msg = stringify(record.msg)
+        if msg is record.msg:
+            msg = dict(msg)
+        msg['time'] = strtime()
+        msg['level'] = record.levelname.lower()
+        record.msg = msg
 
         # Make sure msg is valid JSON.
-        record.msg = json.dumps(record.msg)
+        record.msg = _dumps(record.msg)
         return True
 
     def tty_filter(self, record):
@@ -156,24 +226,24 @@ class DictLogFilter(object):
         """
 
         # Ensure all keys and values are stringified.
-        record.msg = stringify(record.msg)
+        msg = stringify(record.msg)
+        levelno = record.levelno
 
-        # Construct the start of the message.
-        out = '\x1b[{0}m{1}\x1b[0m[{2}] {3}'.format(levelcolor(record.levelno),
-                                                    record.levelname[:4],
-                                                    secs_since(starttime),
-                                                    record.msg.get('msg', ''))
+        # The color escape is the same for the whole record.
+        color = _TTY_CACHE.get(levelno)
+        if color is None:
+            color = '\x1b[{0}m'.format(levelcolor(levelno))
 
-        # Pad to or truncate at 80 characters.
-        out = '{0:<80}'.format(out)
+        # Construct the start of the message, padded to 80 characters.
+        parts = [('%s%s\x1b[0m[%s] %s' % (color, record.levelname[:4],
+                                          secs_since(starttime),
+                                          msg.get('msg', ''))).ljust(80)]
 
         # Format into colorized k=v pairs
-        for k, v in record.msg.items():
-            if k != 'msg':
-                out = out + ' \x1b[{0}m{1}\x1b[0m={2}'\
-                    .format(levelcolor(record.levelno), k, v)
+        parts.extend(' %s%s\x1b[0m=%s' % (color, k, v)
+                     for k, v in msg.items() if k != 'msg')
 
-        record.msg = out
+        record.msg = ''.join(parts)
 
         return True
 
@@ -186,19 +256,23 @@ class DictLogFilter(object):
         :rtype:        bool
         """
 
-        # Add time and level entries.
-        record.msg['time'] = strtime()
-        record.msg['level'] = record.levelname.lower()
-
         # Ensure all keys and values are stringified.
-        record.msg = stringify(record.msg)
+        # Add time and level entries to a copy, leaving the caller's dict be;
+        # stringify only returns the same dict when it needed no changes.
+        msg = stringify(record.msg)
+        if msg is record.msg:
+            msg = dict(msg)
+        msg['time'] = strtime()
+        msg['level'] = record.levelname.lower()
 
         # Attempt to meet the logfmt-compatible format.
-        # Format into k=v pairs, quoting the v's.
-        record.msg = ['{0}="{1}"'.format(k, v) for k, v in record.msg.items()]
+        # Format into k=v pairs, quoting the v's and escaping their
+        # backslashes and quotes.
+        pairs = ['%s="%s"' % (k, _escape_quotes(str(v)))
+                 for k, v in msg.items()]
 
         # Join with a space
-        record.msg = " ".join(record.msg)
+        record.msg = " ".join(pairs)
 
         return True
 
@@ -215,46 +289,151 @@ class DictQueueHandler(QueueHandler):
     This handler attempts to make the log record picklable without converting
     dict msgs to strings. If the msg is a dict, it reconstructs the dict with
     the result of calling str on all its items. If args exist, it does the same
-    there. If exc_info exists, it uses self.formatter.formatException to
-    convert it to string and then stores it in the exc_text attribute and wipes
-    exc_info.
+    there; for other msgs the args are merged into the msg string as the
+    standard QueueHandler does. If exc_info exists, it uses
+    self.exc_formatter.formatException to convert it to string and then stores
+    it in the exc_text attribute and wipes exc_info.
+
+    Rather than pickling the whole LogRecord, only the attributes listed in
+    RECORD_ATTRS are enqueued, as a plain dict, with a dict msg packed by
+    msgpack when it is installed. The consumer rebuilds a record from it with
+    `make_record`.
     """  # noqa
 
-    formatter = logging.Formatter()
+    # Handler.__init__ sets self.formatter to None, so use a separate name.
+    exc_formatter = logging.Formatter()
+
+    RECORD_ATTRS = ('name', 'msg', 'args', 'levelname', 'levelno', 'pathname',
+                    'filename', 'module', 'lineno', 'funcName', 'created',
+                    'msecs', 'relativeCreated', 'process', 'processName',
+                    'exc_text')
 
     def prepare(self, record):
         """Prepare the log record for pickling.
 
-        If record.msg is a mapping, call str on all its items. If record.args
-        is a sequence or mapping, call str on all its items. Convert
-        record.exc_info to a string at record.exc_text, using
-        self.formatter.formatException, and wipe out record.exc_info.
+        If record.msg is a mapping, call str on all its items and, if
+        record.args is a sequence or mapping, on all of its items too.
+        Otherwise merge record.args into the msg string as the standard
+        QueueHandler does, since stringified args would no longer match
+        format specifiers like %d. Convert record.exc_info to a string at
+        record.exc_text, using self.exc_formatter.formatException. If msgpack
+        is installed, a dict msg is packed into msgpack bytes. Return a dict of
+        the RECORD_ATTRS attributes, to be turned back into a record with
+        `make_record`.
 
         :param record: the log record to prepare
         :type record:  logging.LogRecord
-        :returns:      the prepared log record
-        :rtype:        logging.LogRecord
+        :returns:      the record attributes to enqueue
+        :rtype:        dict
         """
 
-        record.msg = stringify(record.msg)
-        record.args = stringify(record.args)
+        packed = False
+        if isinstance(record.msg, Mapping):
+            record.msg = stringify(record.msg)
+            if record.args:
+                record.args = stringify(record.args)
+            if msgpack is not None:
+                record.msg = _pack(record.msg)
+                packed = True
+        else:
+            record.msg = record.getMessage()
+            record.args = None
 
         if record.exc_info:
-            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_text = self.exc_formatter.formatException(
+                record.exc_info)
             record.exc_info = None
 
-        return record
+        attrs = {attr: getattr(record, attr, None)
+                 for attr in self.RECORD_ATTRS}
+        attrs['msgpacked'] = packed
+        return attrs
+
+
+class BatchingDictQueueHandler(DictQueueHandler):
+    """A DictQueueHandler that enqueues prepared records in batches.
+
+    Prepared records are collected in a thread-local buffer and enqueued as a
+    single list once `batch_size` records have accumulated or when `flush` is
+    called, so the queue lock is taken once per batch instead of once per
+    record. Consumers must accept lists of prepared records on the queue.
+    """
+
+    def __init__(self, queue, batch_size=16):
+        """Create the handler.
+
+        :param queue:          the queue to put record batches onto
+        :param int batch_size: number of records to buffer before enqueuing
+        """
+        super(BatchingDictQueueHandler, self).__init__(queue)
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    def _buffer(self):
+        """Return the calling thread's record buffer, creating it if needed.
+
+        :returns: the buffer list
+        :rtype:   list
+        """
+        try:
+            return self._local.buffer
+        except AttributeError:
+            self._local.buffer = []
+            return self._local.buffer
+
+    def emit(self, record):
+        """Prepare the record and buffer it, enqueuing a full batch.
+
+        :param record: the log record to emit
+        :type record:  logging.LogRecord
+        """
+        try:
+            buf = self._buffer()
+            buf.append(self.prepare(record))
+            if len(buf) >= self.batch_size:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Enqueue the calling thread's buffered records, if any."""
+        buf = self._buffer()
+        if buf:
+            self._local.buffer = []
+            self.enqueue(buf)
+
+    def close(self):
+        """Flush the calling thread's buffered records and close."""
+        self.flush()
+        super(BatchingDictQueueHandler, self).close()
+
+
+def make_record(attrs):
+    """Rebuild a log record from a dict made by DictQueueHandler.prepare.
+
+    :param dict attrs: record attributes, possibly with a msgpack msg
+    :returns:          the log record
+    :rtype:            logging.LogRecord
+    """
+    if attrs.pop('msgpacked', False):
+        attrs['msg'] = _unpack(attrs['msg'])
+    return logging.makeLogRecord(attrs)
 
 
 def stringify(obj):
     """Recursively str() an object, leaving mappings and sequences."""
+    # Fast path for the common all-str log dict, which needs no rebuilding.
+    if isinstance(obj, dict) and all(type(k) is str and type(v) is str
+                                     for k, v in obj.items()):
+        return obj
+
     if isinstance(obj, str):
         new_obj = obj
     elif  isinstance(obj, unicode):
         new_obj = str(obj)
-    elif isinstance(obj, collections.Mapping):
+    elif isinstance(obj, Mapping):
         new_obj = {str(k): stringify(v) for k, v in obj.items()}
-    elif isinstance(obj, collections.Sequence):
+    elif isinstance(obj, Sequence) and not isinstance(obj, bytes):
         new_obj = [stringify(i) for i in obj]
     else:
         new_obj = str(obj)
@@ -5,17 +5,16 @@ from pedsnetdcc.abstract_transform import Transform
 
 
 class DropIndexTransform(Transform):
-    drop_by_table = {
-        'adt_occurrence': ('next_adt_occurrence_id','prior_adt_occurrence_id',),
-        'fact_relationship': ('domain_concept_id_1', 'domain_concept_id_2',),
-        'procedure_occurrence': ('provider_id',),
-    }
-    idx_by_column = {
-        'next_adt_occurrence_id': 'idx_adt_next_id',
-        'prior_adt_occurrence_id': 'idx_adt_prior_id',
-        'domain_concept_id_1': 'idx_fact_relationship_id_1',
-        'domain_concept_id_2': 'idx_fact_relationship_id_2',
-        'provider_id': 'idx_procedure_provider_id',
+    # (column name, index name) pairs to drop, by table name.
+    _PLAN = {
+        'adt_occurrence': (('next_adt_occurrence_id', 'idx_adt_next_id'),
+                           ('prior_adt_occurrence_id', 'idx_adt_prior_id'),),
+        'fact_relationship': (('domain_concept_id_1',
+                               'idx_fact_relationship_id_1'),
+                              ('domain_concept_id_2',
+                               'idx_fact_relationship_id_2'),),
+        'procedure_occurrence': (('provider_id',
+                                  'idx_procedure_provider_id'),),
     }
 
     @classmethod
@@ -38,9 +37,7 @@ class DropIndexTransform(Transform):
             if table_name in VOCAB_TABLES:
                 continue
 
-            new_indexs = cls.modify_table(metadata, table)
-            if len(new_indexs) > 0:
-                indexes.extend(cls.modify_table(metadata, table))
+            indexes.extend(cls.modify_table(metadata, table))
 
         return indexes
 
@@ -58,14 +55,8 @@ class DropIndexTransform(Transform):
         See Transform.modify_table for signature.
         """
 
-        indexes = []
-        if not table.name in cls.drop_by_table:
-            return indexes
-        for col_name in cls.drop_by_table[table.name]:
-            col = table.columns[col_name]
-            if not col_name in cls.idx_by_column:
-                continue
-            index_name = cls.idx_by_column.get(col_name, "none")
-            indexes.append(Index(index_name, col))
-
-        return indexes
+        plan = cls._PLAN.get(table.name)
+        if not plan:
+            return []
+        return [Index(index_name, table.columns[col_name])
+                for col_name, index_name in plan]
@@ -1,453 +1,474 @@
 import logging
+import threading
 import time
 import re
 
-from pedsnetdcc.db import StatementSet, Statement, StatementList
+import psycopg2
+
+from pedsnetdcc.db import Statement
 from pedsnetdcc.dict_logging import secs_since
 from pedsnetdcc.schema import (primary_schema)
-from pedsnetdcc.utils import (check_stmt_err, check_stmt_data, combine_dicts,
-                              get_conn_info_dict, vacuum, stock_metadata)
+from pedsnetdcc.utils import (check_stmt_data, check_stmt_err,
+                              combine_dicts, get_conn_info_dict)
 
 logger = logging.getLogger(__name__)
 DROP_PK_CONSTRAINT_ERA_SQL = """alter table {0}_era drop constraint if exists xpk_{0}_era;
     alter table {0}_era drop constraint if exists {0}_era_pkey;"""
 DROP_NULL_ERA_SQL = 'alter table {0}_era alter column {0}_era_id drop not null;'
 IDX_ERA_SQL = 'create index {0} on {1}_era ({2})'
-CONDITION_ERA_SQL= """TRUNCATE {0}.condition_era;
-    DROP TABLE IF EXISTS {1}_cteConditionTarget;
+# Bound how long the era id reservation and the primary key swap wait on
+# locks held by concurrent runs; on lock timeouts, serialization failures and
+# deadlocks (by SQLSTATE) they are retried with backoff.
+LOCK_TIMEOUT_SQL = "SET LOCAL lock_timeout = '30s';\n"
+LOCK_RETRY_PGCODES = frozenset(('55P03', '40001', '40P01'))
+LOCK_RETRY_ATTEMPTS = 5
+# Let the planner run the era window sorts as parallel plans, and keep more
+# of the sorts and aggregates in memory. work_mem applies per sort or hash
+# node in the leader and in each worker, and a derivation has two window
+# sorts and a GROUP BY, so with 4 workers a run can use up to about 2GB
+# (twice that while the drug and condition chains run together). SET LOCAL
+# confines these to the derivation batch's transaction.
+ERA_SETTINGS_SQL = """SET LOCAL max_parallel_workers_per_gather = 4;
+    SET LOCAL parallel_setup_cost = 10;
+    SET LOCAL work_mem = '128MB';"""
+# Reserve a block of ids for the derived eras in the last ID tracking table.
+# This runs in its own short transaction once the eras are staged and
+# counted, so the row lock isn't held while eras are derived or inserted.
+# With negative ids, nothing is reserved unless the whole block is <= 0 (the
+# bound the old per-site negative id sequences had).
+RESERVE_ERA_IDS_SQL = """UPDATE {0}
+    SET last_id = last_id + %(count)s
+    WHERE NOT %(neg_ids)s OR last_id + %(count)s - 1 <= 0
+    RETURNING last_id - %(count)s"""
+# Look up the era concept names while inserting the eras.
+CONCEPT_NAME_JOIN_SQL = """
+    LEFT JOIN vocabulary.concept c ON c.concept_id = eras.{0}_concept_id"""
+CONDITION_ERA_SQL= """DROP TABLE IF EXISTS cteConditionTarget;
     -- create base eras from the concepts found in condition_occurrence
-    CREATE TEMP TABLE {1}_cteConditionTarget
+    CREATE TEMP TABLE cteConditionTarget
     AS
     SELECT
         co.person_id
         ,co.condition_concept_id
         ,co.condition_start_date
-        ,COALESCE(co.condition_end_date, (condition_start_date + 1*INTERVAL'1 day')) AS condition_end_date
+        ,COALESCE(co.condition_end_date, condition_start_date + 1) AS condition_end_date
     FROM
     {0}.condition_occurrence co;
+    ANALYZE cteConditionTarget;
     --------------------------------------
-    DROP TABLE IF EXISTS {1}_cteCondEndDates;
-    CREATE TEMP TABLE {1}_cteCondEndDates
-    AS
-    SELECT
-        person_id
-        ,condition_concept_id
-        ,(event_date+ - 30*INTERVAL'1 day') AS end_date -- unpad the end date
-    FROM
-    (
-        SELECT e1.person_id
-            ,e1.condition_concept_id
-            ,e1.event_date
-            ,COALESCE(e1.start_ordinal, MAX(e2.start_ordinal)) start_ordinal
-            ,e1.overall_ord
+    -- collapse each island into an era; occurrences sharing a start date
+    -- count once
+    DROP TABLE IF EXISTS cteConditionEras;
+    CREATE TEMP TABLE cteConditionEras
+    AS (
+        SELECT row_number() OVER () AS site_id
+            ,person_id
+            ,condition_concept_id
+            ,min(condition_start_date) AS condition_era_start_date
+            ,max(condition_end_date) AS condition_era_end_date
+            ,COUNT(DISTINCT condition_start_date) AS condition_occurrence_count
         FROM (
-            SELECT person_id
+            -- number the eras (islands) per person and concept: a condition
+            -- starts a new era when it starts more than 30 days after every
+            -- earlier one ended
+            SELECT
+                person_id
                 ,condition_concept_id
-                ,event_date
-                ,event_type
-                ,start_ordinal
-                ,ROW_NUMBER() OVER (
+                ,condition_start_date
+                ,condition_end_date
+                ,SUM(is_new) OVER (
                     PARTITION BY person_id
-                    ,condition_concept_id ORDER BY event_date
-                        ,event_type
-                    ) AS overall_ord -- this re-numbers the inner UNION so all rows are numbered ordered by the event date
-            FROM (
-                -- select the start dates, assigning a row number to each
-                SELECT person_id
-                    ,condition_concept_id
-                    ,condition_start_date AS event_date
-                    ,- 1 AS event_type
-                    ,ROW_NUMBER() OVER (
-                        PARTITION BY person_id
-                        ,condition_concept_id ORDER BY condition_start_date
-                        ) AS start_ordinal
-                FROM {1}_cteConditionTarget
-                UNION ALL
-                -- pad the end dates by 30 to allow a grace period for overlapping ranges.
+                    ,condition_concept_id ORDER BY condition_start_date
+                        ,condition_end_date
+                    ROWS UNBOUNDED PRECEDING
+                    ) AS island_id
+            FROM
+            (
                 SELECT person_id
                     ,condition_concept_id
-                    ,(condition_end_date + 30*INTERVAL'1 day')
-                    ,1 AS event_type
-                    ,NULL
-                FROM {1}_cteConditionTarget
-                ) RAWDATA
-            ) e1
-        INNER JOIN (
-            SELECT person_id
-                ,condition_concept_id
-                ,condition_start_date AS event_date
-                ,ROW_NUMBER() OVER (
-                    PARTITION BY person_id
-                    ,condition_concept_id ORDER BY condition_start_date
-                    ) AS start_ordinal
-            FROM {1}_cteConditionTarget
-            ) e2 ON e1.person_id = e2.person_id
-            AND e1.condition_concept_id = e2.condition_concept_id
-            AND e2.event_date<= e1.event_date
-        GROUP BY e1.person_id
-            ,e1.condition_concept_id
-            ,e1.event_date
-            ,e1.start_ordinal
-            ,e1.overall_ord
-        ) e
-    WHERE (2 * e.start_ordinal) - e.overall_ord = 0;
-    ------------------------------------------------
-    DROP TABLE IF EXISTS {1}_cteConditionEnds;
-    CREATE TEMP TABLE {1}_cteConditionEnds
-    AS
-    SELECT
-        c.person_id
-        ,c.condition_concept_id
-        ,c.condition_start_date
-        ,MIN(e.end_date) AS era_end_date
-    FROM
-    {1}_cteConditionTarget c
-    INNER JOIN {1}_cteCondEndDates e ON c.person_id = e.person_id
-        AND c.condition_concept_id = e.condition_concept_id
-        AND e.end_date >= c.condition_start_date
-    GROUP BY c.person_id
-        ,c.condition_concept_id
-        ,c.condition_start_date;
-    -------------------------------
+                    ,condition_start_date
+                    ,condition_end_date
+                    ,CASE WHEN condition_start_date <= MAX(condition_end_date) OVER (
+                            PARTITION BY person_id
+                            ,condition_concept_id ORDER BY condition_start_date
+                                ,condition_end_date
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                            ) + 30
+                        THEN 0 ELSE 1 END AS is_new
+                FROM cteConditionTarget
+                ) t
+            ) islands
+        GROUP BY person_id
+            ,condition_concept_id
+            ,island_id
+        );
+    SELECT count(*) FROM cteConditionEras;
+"""
+# Insert the staged eras, numbering the ids from the reserved block (or
+# leaving them NULL when old_last_id is NULL).
+CONDITION_ERA_INSERT_SQL = """TRUNCATE {0}.condition_era;
     INSERT INTO {0}.condition_era (
         site_id
+        ,condition_era_id
         ,person_id
         ,condition_concept_id
         ,condition_era_start_date
         ,condition_era_end_date
         ,condition_occurrence_count
+        ,condition_concept_name
         ,site
         )
-    SELECT row_number() OVER (
-            ORDER BY person_id
-            ) AS site_id
+    SELECT site_id
+        ,%(old_last_id)s + site_id - 1
         ,person_id
         ,condition_concept_id
-        ,min(condition_start_date) AS condition_era_start_date
-        ,era_end_date AS condition_era_end_date
-        ,COUNT(*) AS condition_occurrencee_count
-        ,'{1}'
-    FROM {1}_cteConditionEnds
-    GROUP BY person_id
-        ,condition_concept_id
-        ,era_end_date;
+        ,condition_era_start_date
+        ,condition_era_end_date
+        ,condition_occurrence_count
+        ,{concept_name}
+        ,%(site)s
+    FROM cteConditionEras eras{concept_join};
+"""
+# Drug concept to RxNorm ingredient lookup, built from the vocabulary into a
+# temp table on each run (so it always matches the loaded vocabulary) and
+# indexed for the drug_exposure join.
+RXNORM_INGREDIENT_MAP_SQL = """DROP TABLE IF EXISTS rxnorm_ingredient_map;
+    CREATE TEMP TABLE rxnorm_ingredient_map
+    AS
+    SELECT ca.descendant_concept_id AS drug_concept_id
+        ,c.concept_id AS ingredient_concept_id
+    FROM {0}.concept_ancestor ca
+    INNER JOIN {0}.concept c ON ca.ancestor_concept_id = c.concept_id
+    WHERE c.vocabulary_id = 'RxNorm'
+        AND c.concept_class_id = 'Ingredient';
+    CREATE INDEX ON rxnorm_ingredient_map (drug_concept_id);
+    ANALYZE rxnorm_ingredient_map;
 """
-DRUG_ERA_SQL = """TRUNCATE {0}.drug_era;
-    DROP TABLE IF EXISTS {2}_cteDrugTarget;
+# Drug concept to RxNorm Clinical Drug Form lookup for the SCDF eras, built
+# per run like the ingredient map.
+RXNORM_SCDF_MAP_SQL = """DROP TABLE IF EXISTS rxnorm_scdf_map;
+    CREATE TEMP TABLE rxnorm_scdf_map
+    AS
+    SELECT ca.descendant_concept_id AS drug_concept_id
+        ,c.concept_id AS scdf_concept_id
+    FROM {0}.concept_ancestor ca
+    INNER JOIN {0}.concept c ON ca.ancestor_concept_id = c.concept_id
+    WHERE c.vocabulary_id = 'RxNorm'
+        AND c.concept_class_id = 'Clinical Drug Form';
+    CREATE INDEX ON rxnorm_scdf_map (drug_concept_id);
+    ANALYZE rxnorm_scdf_map;
+"""
+DRUG_ERA_SQL = """DROP TABLE IF EXISTS cteDrugTarget;
     -- Normalize drug_exposure_end_date to either the existing drug exposure end date, or add days supply, or add 1 day to the start date
-    CREATE TEMP TABLE {2}_cteDrugTarget
+    CREATE TEMP TABLE cteDrugTarget
     AS
     SELECT
-        d.drug_exposure_id
-        ,d.person_id
-        ,c.concept_id
+        d.person_id
         ,d.drug_type_concept_id
         ,drug_exposure_start_date
-        ,COALESCE(drug_exposure_end_date, (drug_exposure_start_date + days_supply*INTERVAL'1 day'), (drug_exposure_start_date + 1*INTERVAL'1 day')) AS drug_exposure_end_date
-        ,c.concept_id AS ingredient_concept_id
+        ,COALESCE(drug_exposure_end_date, drug_exposure_start_date + days_supply, drug_exposure_start_date + 1) AS drug_exposure_end_date
+        ,m.ingredient_concept_id
     FROM
     {0}.drug_exposure d
-    INNER JOIN {1}.concept_ancestor ca ON ca.descendant_concept_id = d.drug_concept_id
-    INNER JOIN {1}.concept c ON ca.ancestor_concept_id = c.concept_id
-    WHERE c.vocabulary_id = 'RxNorm'
-        AND c.concept_class_id = 'Ingredient';
+    INNER JOIN rxnorm_ingredient_map m ON m.drug_concept_id = d.drug_concept_id
+    WHERE d.drug_concept_id <> 0;
+    ANALYZE cteDrugTarget;
     ------------------------------------																								 
-    DROP TABLE IF EXISTS {2}_cteEndDates;
-    CREATE TEMP TABLE {2}_cteEndDates
-    AS
-    SELECT
-        person_id
-        ,ingredient_concept_id
-        ,(event_date + - 30*INTERVAL'1 day') AS end_date -- unpad the end date
-    FROM
-    (
-        SELECT e1.person_id
-            ,e1.ingredient_concept_id
-            ,e1.event_date
-            ,COALESCE(e1.start_ordinal, MAX(e2.start_ordinal)) start_ordinal
-            ,e1.overall_ord
+    -- collapse each island into one era per drug type, ending when the island
+    -- ends; exposures sharing a start date count once
+    DROP TABLE IF EXISTS cteDrugEras;
+    CREATE TEMP TABLE cteDrugEras
+    AS (
+        SELECT ingredient_concept_id AS drug_concept_id
+            ,MAX(MAX(drug_exposure_end_date)) OVER (
+                PARTITION BY person_id
+                ,ingredient_concept_id
+                ,island_id
+                ) AS drug_era_end_date
+            ,min(drug_exposure_start_date) AS drug_era_start_date
+            ,COUNT(DISTINCT drug_exposure_start_date) AS drug_exposure_count
+            -- site_id only needs to be unique within the site's drug_era
+            ,ROW_NUMBER() OVER () AS site_id
+            ,person_id AS person_id
         FROM (
-            SELECT person_id
+            -- number the eras (islands) per person and concept: an exposure
+            -- starts a new era when it starts more than 30 days after every
+            -- earlier one ended
+            SELECT
+                person_id
                 ,ingredient_concept_id
-                ,event_date
-                ,event_type
-                ,start_ordinal
-                ,ROW_NUMBER() OVER (
+                ,drug_type_concept_id
+                ,drug_exposure_start_date
+                ,drug_exposure_end_date
+                ,SUM(is_new) OVER (
                     PARTITION BY person_id
-                    ,ingredient_concept_id ORDER BY event_date
-                        ,event_type
-                    ) AS overall_ord -- this re-numbers the inner UNION so all rows are numbered ordered by the event date
-            FROM (
-                -- select the start dates, assigning a row number to each
-                SELECT person_id
-                    ,ingredient_concept_id
-                    ,drug_exposure_start_date AS event_date
-                    ,0 AS event_type
-                    ,ROW_NUMBER() OVER (
-                        PARTITION BY person_id
-                        ,ingredient_concept_id ORDER BY drug_exposure_start_date
-                        ) AS start_ordinal
-                FROM {2}_cteDrugTarget
-                UNION ALL
-                -- add the end dates with NULL as the row number, padding the end dates by 30 to allow a grace period for overlapping ranges.
+                    ,ingredient_concept_id ORDER BY drug_exposure_start_date
+                        ,drug_exposure_end_date
+                    ROWS UNBOUNDED PRECEDING
+                    ) AS island_id
+            FROM
+            (
                 SELECT person_id
                     ,ingredient_concept_id
-                    ,(drug_exposure_end_date + 30*INTERVAL'1 day')
-                    ,1 AS event_type
-                    ,NULL
-                FROM {2}_cteDrugTarget
-                ) RAWDATA
-            ) e1
-        INNER JOIN (
-            SELECT person_id
-                ,ingredient_concept_id
-                ,drug_exposure_start_date AS event_date
-                ,ROW_NUMBER() OVER (
-                    PARTITION BY person_id
-                    ,ingredient_concept_id ORDER BY drug_exposure_start_date
-                    ) AS start_ordinal
-            FROM {2}_cteDrugTarget
-            ) e2 ON e1.person_id = e2.person_id
-            AND e1.ingredient_concept_id = e2.ingredient_concept_id
-            AND e2.event_date <= e1.event_date
-        GROUP BY e1.person_id
-            ,e1.ingredient_concept_id
-            ,e1.event_date
-            ,e1.start_ordinal
-            ,e1.overall_ord
-        ) e
-    WHERE 2 * e.start_ordinal - e.overall_ord = 0;
-    ----------------------------------------------
-    DROP TABLE IF EXISTS {2}_cteDrugExpEnds;
-    CREATE TEMP TABLE {2}_cteDrugExpEnds
-    AS
-    SELECT
-        d.person_id
-        ,d.ingredient_concept_id
-        ,d.drug_type_concept_id
-        ,d.drug_exposure_start_date
-        ,MIN(e.end_date) AS era_end_date
-    FROM
-    {2}_cteDrugTarget d
-    INNER JOIN {2}_cteEndDates e ON d.person_id = e.person_id
-        AND d.ingredient_concept_id = e.ingredient_concept_id
-        AND e.end_date >= d.drug_exposure_start_date
-    GROUP BY d.person_id
-        ,d.ingredient_concept_id
-        ,d.drug_type_concept_id
-        ,d.drug_exposure_start_date;
-    ------------------------------------------				  
+                    ,drug_type_concept_id
+                    ,drug_exposure_start_date
+                    ,drug_exposure_end_date
+                    ,CASE WHEN drug_exposure_start_date <= MAX(drug_exposure_end_date) OVER (
+                            PARTITION BY person_id
+                            ,ingredient_concept_id ORDER BY drug_exposure_start_date
+                                ,drug_exposure_end_date
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                            ) + 30
+                        THEN 0 ELSE 1 END AS is_new
+                FROM cteDrugTarget
+                ) t
+            ) islands
+        GROUP BY person_id
+            ,ingredient_concept_id
+            ,drug_type_concept_id
+            ,island_id
+        );
+    SELECT count(*) FROM cteDrugEras;
+"""
+DRUG_ERA_INSERT_SQL = """TRUNCATE {0}.drug_era;
     INSERT INTO {0}.drug_era
-    SELECT ingredient_concept_id AS drug_concept_id
-        ,era_end_date AS drug_era_end_date
-        ,min(drug_exposure_start_date) AS drug_era_start_date
-        ,COUNT(*) AS drug_exposure_count
+    SELECT drug_concept_id
+        ,drug_era_end_date
+        ,drug_era_start_date
+        ,drug_exposure_count
         ,30 AS gap_days
-        ,NULL AS drug_concept_name
-        ,'{2}' AS site
-        ,NULL as drug_era_id
-        ,ROW_NUMBER() OVER (
-            ORDER BY person_id
-            ) AS site_id
-        ,person_id AS person_id
-    FROM {2}_cteDrugExpEnds
-    GROUP BY person_id
-        ,ingredient_concept_id
-        ,drug_type_concept_id
-        ,era_end_date;
+        ,{concept_name} AS drug_concept_name
+        ,%(site)s AS site
+        ,%(old_last_id)s + site_id - 1 AS drug_era_id
+        ,site_id
+        ,person_id
+    FROM cteDrugEras eras{concept_join};
     """
 
 DRUG_ERA_SCDF_SQL = """
-    DROP TABLE IF EXISTS {0}.drug_scdf_era;
-    CREATE TABLE {0}.drug_scdf_era (LIKE {0}.drug_era);
-    alter table {0}.drug_scdf_era alter column drug_era_id drop not null;
-    DROP TABLE IF EXISTS {2}_cteDrug2Target;
+    DROP TABLE IF EXISTS cteDrug2Target;
     -- Normalize drug_exposure_end_date to either the existing drug exposure end date, or add days supply, or add 1 day to the start date
-    CREATE TEMP TABLE {2}_cteDrug2Target
+    CREATE TEMP TABLE cteDrug2Target
     AS
     SELECT
-        d.drug_exposure_id
-        ,d.person_id
-        ,c.concept_id
+        d.person_id
         ,d.drug_type_concept_id
         ,drug_exposure_start_date
-        ,COALESCE(drug_exposure_end_date, (drug_exposure_start_date + days_supply*INTERVAL'1 day'), (drug_exposure_start_date + 1*INTERVAL'1 day')) AS drug_exposure_end_date
-        ,c.concept_id AS scdf_concept_id
+        ,COALESCE(drug_exposure_end_date, drug_exposure_start_date + days_supply, drug_exposure_start_date + 1) AS drug_exposure_end_date
+        ,m.scdf_concept_id
     FROM
     {0}.drug_exposure d
-    INNER JOIN {1}.concept_ancestor ca ON ca.descendant_concept_id = d.drug_concept_id
-    INNER JOIN {1}.concept c ON ca.ancestor_concept_id = c.concept_id
-    WHERE c.vocabulary_id = 'RxNorm'
-        AND c.concept_class_id = 'Clinical Drug Form';
+    INNER JOIN rxnorm_scdf_map m ON m.drug_concept_id = d.drug_concept_id
+    WHERE d.drug_concept_id <> 0;
+    ANALYZE cteDrug2Target;
     ------------------------------------																								 
-    DROP TABLE IF EXISTS {2}_cteEnd2Dates;
-    CREATE TEMP TABLE {2}_cteEnd2Dates
-    AS
-    SELECT
-        person_id
-        ,scdf_concept_id
-        ,(event_date + - 30*INTERVAL'1 day') AS end_date -- unpad the end date
-    FROM
-    (
-        SELECT e1.person_id
-            ,e1.scdf_concept_id
-            ,e1.event_date
-            ,COALESCE(e1.start_ordinal, MAX(e2.start_ordinal)) start_ordinal
-            ,e1.overall_ord
+    -- collapse each island into one era per drug type, ending when the island
+    -- ends; exposures sharing a start date count once
+    DROP TABLE IF EXISTS cteDrug2Eras;
+    CREATE TEMP TABLE cteDrug2Eras
+    AS (
+        SELECT scdf_concept_id AS drug_concept_id
+            ,MAX(MAX(drug_exposure_end_date)) OVER (
+                PARTITION BY person_id
+                ,scdf_concept_id
+                ,island_id
+                ) AS drug_era_end_date
+            ,min(drug_exposure_start_date) AS drug_era_start_date
+            ,COUNT(DISTINCT drug_exposure_start_date) AS drug_exposure_count
+            -- numbered from 1 here; the INSERT moves site_id past the
+            -- drug eras already in drug_era, which SCDF eras are merged into
+            ,ROW_NUMBER() OVER () AS site_id
+            ,person_id AS person_id
         FROM (
-            SELECT person_id
+            -- number the eras (islands) per person and concept: an exposure
+            -- starts a new era when it starts more than 30 days after every
+            -- earlier one ended
+            SELECT
+                person_id
                 ,scdf_concept_id
-                ,event_date
-                ,event_type
-                ,start_ordinal
-                ,ROW_NUMBER() OVER (
+                ,drug_type_concept_id
+                ,drug_exposure_start_date
+                ,drug_exposure_end_date
+                ,SUM(is_new) OVER (
                     PARTITION BY person_id
-                    ,scdf_concept_id ORDER BY event_date
-                        ,event_type
-                    ) AS overall_ord -- this re-numbers the inner UNION so all rows are numbered ordered by the event date
-            FROM (
-                -- select the start dates, assigning a row number to each
-                SELECT person_id
-                    ,scdf_concept_id
-                    ,drug_exposure_start_date AS event_date
-                    ,0 AS event_type
-                    ,ROW_NUMBER() OVER (
-                        PARTITION BY person_id
-                        ,scdf_concept_id ORDER BY drug_exposure_start_date
-                        ) AS start_ordinal
-                FROM {2}_cteDrug2Target
-                UNION ALL
-                -- add the end dates with NULL as the row number, padding the end dates by 30 to allow a grace period for overlapping ranges.
+                    ,scdf_concept_id ORDER BY drug_exposure_start_date
+                        ,drug_exposure_end_date
+                    ROWS UNBOUNDED PRECEDING
+                    ) AS island_id
+            FROM
+            (
                 SELECT person_id
                     ,scdf_concept_id
-                    ,(drug_exposure_end_date + 30*INTERVAL'1 day')
-                    ,1 AS event_type
-                    ,NULL
-                FROM {2}_cteDrug2Target
-                ) RAWDATA
-            ) e1
-        INNER JOIN (
-            SELECT person_id
-                ,scdf_concept_id
-                ,drug_exposure_start_date AS event_date
-                ,ROW_NUMBER() OVER (
-                    PARTITION BY person_id
-                    ,scdf_concept_id ORDER BY drug_exposure_start_date
-                    ) AS start_ordinal
-            FROM {2}_cteDrug2Target
-            ) e2 ON e1.person_id = e2.person_id
-            AND e1.scdf_concept_id = e2.scdf_concept_id
-            AND e2.event_date <= e1.event_date
-        GROUP BY e1.person_id
-            ,e1.scdf_concept_id
-            ,e1.event_date
-            ,e1.start_ordinal
-            ,e1.overall_ord
-        ) e
-    WHERE 2 * e.start_ordinal - e.overall_ord = 0;
-    ----------------------------------------------
-    DROP TABLE IF EXISTS {2}_cteDrug2ExpEnds;
-    CREATE TEMP TABLE {2}_cteDrug2ExpEnds
-    AS
-    SELECT
-        d.person_id
-        ,d.scdf_concept_id
-        ,d.drug_type_concept_id
-        ,d.drug_exposure_start_date
-        ,MIN(e.end_date) AS era_end_date
-    FROM
-    {2}_cteDrug2Target d
-    INNER JOIN {2}_cteEnd2Dates e ON d.person_id = e.person_id
-        AND d.scdf_concept_id = e.scdf_concept_id
-        AND e.end_date >= d.drug_exposure_start_date
-    GROUP BY d.person_id
-        ,d.scdf_concept_id
-        ,d.drug_type_concept_id
-        ,d.drug_exposure_start_date;
-    ------------------------------------------				  
+                    ,drug_type_concept_id
+                    ,drug_exposure_start_date
+                    ,drug_exposure_end_date
+                    ,CASE WHEN drug_exposure_start_date <= MAX(drug_exposure_end_date) OVER (
+                            PARTITION BY person_id
+                            ,scdf_concept_id ORDER BY drug_exposure_start_date
+                                ,drug_exposure_end_date
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                            ) + 30
+                        THEN 0 ELSE 1 END AS is_new
+                FROM cteDrug2Target
+                ) t
+            ) islands
+        GROUP BY person_id
+            ,scdf_concept_id
+            ,drug_type_concept_id
+            ,island_id
+        );
+    SELECT count(*) FROM cteDrug2Eras;
+"""
+DRUG_ERA_SCDF_INSERT_SQL = """DROP TABLE IF EXISTS {0}.drug_scdf_era;
+    CREATE TABLE {0}.drug_scdf_era (LIKE {0}.drug_era);
+    alter table {0}.drug_scdf_era alter column drug_era_id drop not null;
     INSERT INTO {0}.drug_scdf_era
-    SELECT scdf_concept_id AS drug_concept_id
-        ,era_end_date AS drug_era_end_date
-        ,min(drug_exposure_start_date) AS drug_era_start_date
-        ,COUNT(*) AS drug_exposure_count
+    SELECT drug_concept_id
+        ,drug_era_end_date
+        ,drug_era_start_date
+        ,drug_exposure_count
         ,30 AS gap_days
-        ,NULL AS drug_concept_name
-        ,'{2}' AS site
-        ,NULL as drug_era_id
-        ,ROW_NUMBER() OVER (
-            ORDER BY person_id
-            ) AS site_id
-        ,person_id AS person_id
-    FROM {2}_cteDrug2ExpEnds
-    GROUP BY person_id
-        ,scdf_concept_id
-        ,drug_type_concept_id
-        ,era_end_date;
+        ,{concept_name} AS drug_concept_name
+        ,%(site)s AS site
+        ,%(old_last_id)s + site_id - 1 AS drug_era_id
+        ,site_id + (SELECT COALESCE(MAX(d.site_id), 0) FROM {0}.drug_era d)
+        ,person_id
+    FROM cteDrug2Eras eras{concept_join};
     """
 
+# Merge the SCDF eras into drug_era.
+COPY_TO_DRUG_ERA_SQL = """INSERT INTO {0}.drug_era(
+                drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
+                gap_days, drug_concept_name, site, drug_era_id, site_id, person_id)
+                (select drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
+                gap_days, drug_concept_name, site, drug_era_id, site_id, person_id
+                from {0}.drug_scdf_era) ON CONFLICT DO NOTHING;"""
 drop_drug_scdf_era_sql = "DROP TABLE IF EXISTS {0}.drug_scdf_era;"
 drop_drug_scdf_era_msg = "dropping {0}.drug_scdf_era"
 
 
-def _fill_concept_names(conn_str, era_type, site):
-    fill_concept_names_sql = """UPDATE {0}_era era
-        SET {2}_concept_name=v.{2}_concept_name,site='{1}'
-        FROM ( SELECT
-        e.{2}_era_id AS {2}_id,
-        v1.concept_name AS {2}_concept_name
-        FROM {0}_era AS e
-        LEFT JOIN vocabulary.concept AS v1 ON e.{2}_concept_id = v1.concept_id
-        ) v
-        WHERE era.{2}_era_id = v.{2}_id"""
+_derivation_sql_cache = {}
 
-    fill_concept_names_msg = "adding concept names"
 
-    temp_era_type = era_type
-    if era_type == 'drug_scdf':
-        temp_era_type = 'drug'
-
-    # Add concept names
-    add_era_ids_stmt = Statement(fill_concept_names_sql.format(era_type, site, temp_era_type), fill_concept_names_msg)
-
-    # Execute the add concept names statement and ensure it didn't error
-    add_era_ids_stmt.execute(conn_str)
-    check_stmt_err(add_era_ids_stmt, 'add concept names')
+def _derivation_sql(era_type, schema, concept_names=True):
+    """Return the formatted derivation and insert SQL for an era type
 
+    The derivation SQL stages the eras in a temp table and selects their
+    count; the insert SQL (run on the same connection) writes the staged
+    eras to the era table. The templates are several KB each, so the
+    formatted SQL is cached per (era_type, schema, concept_names). The site
+    and the first reserved era id are not formatted in: execute the insert
+    SQL with `site` and `old_last_id` query parameters.
 
-    # If reached without error, then success!
-    return True
+    :param str era_type: type of era derivation (condition, drug or drug_scdf)
+    :param str schema:   schema holding the source and era tables
+    :param bool concept_names: if True, fill in the era concept names
+    :returns:            (planner settings, lookup and derivation SQL,
+                         insert SQL)
+    :rtype:              tuple
+    """
+    key = (era_type, schema, concept_names)
+    sql = _derivation_sql_cache.get(key)
+    if sql is None:
+        # drug_scdf eras use the drug_era column names.
+        base_type = 'drug' if era_type == 'drug_scdf' else era_type
+        fill = {'concept_name': 'NULL', 'concept_join': ''}
+        if concept_names:
+            fill.update({'concept_name': 'c.concept_name',
+                         'concept_join': CONCEPT_NAME_JOIN_SQL.format(base_type)})
+        parts = [ERA_SETTINGS_SQL]
+        if era_type == "condition":
+            parts.append(CONDITION_ERA_SQL.format(schema))
+            insert_sql = CONDITION_ERA_INSERT_SQL.format(schema, **fill)
+        elif era_type == "drug_scdf":
+            parts.append(RXNORM_SCDF_MAP_SQL.format("vocabulary"))
+            parts.append(DRUG_ERA_SCDF_SQL.format(schema))
+            insert_sql = DRUG_ERA_SCDF_INSERT_SQL.format(schema, **fill)
+        else:
+            parts.append(RXNORM_INGREDIENT_MAP_SQL.format("vocabulary"))
+            parts.append(DRUG_ERA_SQL.format(schema))
+            insert_sql = DRUG_ERA_INSERT_SQL.format(schema, **fill)
+        sql = _derivation_sql_cache.setdefault(key, ('\n'.join(parts),
+                                                     insert_sql))
+    return sql
+
+
+def _reserve_era_ids(era_type, conn_str, id_name, count, neg_ids=False):
+    """Reserve a block of era ids from the last ID tracking table
+
+    The reservation is its own short transaction, retried on lock
+    contention with a concurrent run's reservation.
+
+    :param str era_type: type of era derivation (condition, drug or drug_scdf)
+    :param str conn_str: database connection string
+    :param str id_name:  name of the id (ex. dcc or onco)
+    :param int count:    number of ids to reserve
+    :param bool neg_ids: if True, only reserve ids <= 0
+    :returns:            the last id before the reserved block (the eras
+                         are numbered from it)
+    :rtype:              int
+    :raises DatabaseError: if the reservation errors
+    :raises ValueError:  if neg_ids is set and the block would go above 0
+    """
+    # drug_scdf eras use the drug_era id range.
+    base_type = 'drug' if era_type == 'drug_scdf' else era_type
+    id_table = '{0}_{1}_era_id'.format(id_name, base_type)
+    reserve_stmt = Statement(LOCK_TIMEOUT_SQL + RESERVE_ERA_IDS_SQL.format(id_table),
+                             'reserving {0} {1}_era ids'.format(count, era_type),
+                             params={'count': count, 'neg_ids': neg_ids})
+    _execute_with_lock_retry(reserve_stmt, conn_str)
+    check_stmt_err(reserve_stmt, 'reserve {0}_era ids'.format(era_type))
+    if neg_ids and not reserve_stmt.data:
+        err = ValueError('{0} negative ids do not fit below 0 in {1}'.format(
+            count, id_table))
+        logger.error({'msg': 'exiting reserve {0}_era ids'.format(era_type),
+                      'err': err})
+        raise err
+    check_stmt_data(reserve_stmt, 'reserve {0}_era ids'.format(era_type))
+    old_last_id = reserve_stmt.data[0][0]
+    logger.info({'msg': 'reserved {0}_era ids'.format(era_type),
+                 'old_last_id': old_last_id, 'count': count})
+    return old_last_id
+
+
+# Columns copied to dcc_pedsnet, keyed by era type.
+_CONDITION_ERA_COLUMNS = """condition_concept_id, condition_era_end_date, condition_era_start_date,
+        condition_occurrence_count, condition_concept_name, site, condition_era_id,
+        site_id, person_id"""
+_DRUG_ERA_COLUMNS = """drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count,
+        gap_days, drug_concept_name, site, drug_era_id, site_id, person_id"""
+# (source table, dcc table, era id column, columns)
+_COPY_TO_DCC = {
+    'condition': ('condition_era', 'condition_era', 'condition_era_id',
+                  _CONDITION_ERA_COLUMNS),
+    'drug': ('drug_era', 'drug_era', 'drug_era_id', _DRUG_ERA_COLUMNS),
+    'drug_scdf': ('drug_scdf_era', 'drug_era', 'drug_era_id',
+                  _DRUG_ERA_COLUMNS),
+}
 
 
 def _copy_to_dcc_table(conn_str, era_type, schema):
-    copy_to_condition_sql = """INSERT INTO dcc_pedsnet.condition_era(
-        condition_concept_id, condition_era_end_date, condition_era_start_date, 
-        condition_occurrence_count, condition_concept_name, site, condition_era_id, 
-        site_id, person_id)
-        (select condition_concept_id, condition_era_end_date, condition_era_start_date, 
-        condition_occurrence_count, condition_concept_name, site, condition_era_id, 
-        site_id, person_id
-        from {0}.condition_era) ON CONFLICT DO NOTHING"""
-    copy_to_drug_sql = """INSERT INTO dcc_pedsnet.drug_era(
-        drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-        gap_days, drug_concept_name, site, drug_era_id, site_id, person_id)
-        (select drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-        gap_days, drug_concept_name, site, drug_era_id, site_id, person_id
-        from {0}.drug_era) ON CONFLICT DO NOTHING"""
-    copy_to_drug_scdf_sql = """INSERT INTO dcc_pedsnet.drug_era(
-            drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-            gap_days, drug_concept_name, site, drug_era_id, site_id, person_id)
-            (select drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-            gap_days, drug_concept_name, site, drug_era_id, site_id, person_id
-            from {0}.drug_scdf_era) ON CONFLICT DO NOTHING"""
+    # Rows whose id is already in dcc_pedsnet are skipped by the anti-join,
+    # which only looks at dcc_pedsnet ids within the source table's id
+    # range so it can be answered from a range scan of the primary key.
+    # ON CONFLICT only covers rows inserted concurrently by another run.
+    copy_to_dcc_sql = """WITH bounds AS (
+            select min({3}) AS lo, max({3}) AS hi from {0}.{1})
+        INSERT INTO dcc_pedsnet.{2}(
+        {4})
+        (select {4}
+        from {0}.{1} s
+        where not exists (select 1 from dcc_pedsnet.{2} d
+                          where d.{3} between (select lo from bounds)
+                                          and (select hi from bounds)
+                          and d.{3} = s.{3})) ON CONFLICT DO NOTHING"""
     copy_to_msg = "copying {0}_era to dcc_pedsnet"
 
     # Insert era data into dcc_pedsnet era table
-    if era_type == "condition":
-        copy_to_stmt = Statement(copy_to_condition_sql.format(schema), copy_to_msg.format(era_type))
-    if era_type == "drug_scdf":
-        copy_to_stmt = Statement(copy_to_drug_scdf_sql.format(schema), copy_to_msg.format(era_type))
-    else:
-        copy_to_stmt = Statement(copy_to_drug_sql.format(schema), copy_to_msg.format(era_type))
+    source, target, id_col, columns = _COPY_TO_DCC[era_type]
+    copy_to_stmt = Statement(copy_to_dcc_sql.format(schema, source, target,
+                                                    id_col, columns),
+                             copy_to_msg.format(era_type))
 
     # Execute the insert era statement and ensure it didn't error
     copy_to_stmt.execute(conn_str)
@@ -457,74 +478,31 @@ def _copy_to_dcc_table(conn_str, era_type, schema):
     return True
 
 
-def _copy_to_drug_era_table(conn_str, schema):
-    copy_to_drug_era_sql = """INSERT INTO {0}.drug_era(
-                drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-                gap_days, drug_concept_name, site, drug_era_id, site_id, person_id)
-                (select drug_concept_id, drug_era_end_date, drug_era_start_date, drug_exposure_count, 
-                gap_days, drug_concept_name, site, drug_era_id, site_id, person_id
-                from {0}.drug_scdf_era) ON CONFLICT DO NOTHING"""
-    copy_to_msg = "copying drug_scdf_era to {0}.drug_era"
-
-    # Insert era data into dcc_pedsnet era table
-    copy_to_stmt = Statement(copy_to_drug_era_sql.format(schema), copy_to_msg.format(schema))
-
-    # Execute the insert era statement and ensure it didn't error
-    copy_to_stmt.execute(conn_str)
-    check_stmt_err(copy_to_stmt, 'insert drug_scdf_era data')
-
-    # If reached without error, then success!
-    return True
-
-
-def _renumber_drug_era_table(conn_str, schema):
-    renumber_drug_era_sql = """
-        update {0}.drug_era d
-        set site_id = nn.new_number
-        from (
-            select drug_era_id, 
-                person_id,
-                row_number() over (order by person_id) as new_number
-        from {0}.drug_era
-        ) nn
-        where nn.drug_era_id = d.drug_era_id;
-    """
-    renumber_drug_era_msg = "renumbering site_id for {0}.drug_era"
-
-    # Renumber site_id
-    renumber_stmt = Statement(renumber_drug_era_sql.format(schema), renumber_drug_era_msg.format(schema))
-
-    # Execute the insert era statement and ensure it didn't error
-    renumber_stmt.execute(conn_str)
-    check_stmt_err(renumber_stmt, 'renumber site_id')
-
-    # If reached without error, then success!
-    return True
-
-
 def run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept, search_path, model_version, id_name,
             notable=False, nopk=False, novac=False):
     """Run the Condition or Drug Era derivation.
 
-    * Execute SQL
-    * Add Ids
-    * Add the concept names
+    * Derive the eras into a temp table
+    * Reserve their Ids
+    * Insert them, assigning Ids and concept names
     * Copy to dcc_pedsnet (if selected)
-    * Vacuum output table
+    * Analyze output table
 
     :param str era_type:    type of derivation (condition or drug)
     :param str conn_str:      database connection string
     :param str site:    site to run derivation for
     :param bool copy: if True, copy results to dcc_pedsnet
-    :param bool neg_ids: if True, use negative ids
+    :param bool neg_ids: if True, use negative ids (the id range has to
+                         stay <= 0)
     :param bool no_ids: if True, don't assign ids
     :param bool no_concept: if True, don't add concept names
     :param str search_path: PostgreSQL schema search path
-    :param str model_version: pedsnet model version, e.g. 2.3.0
+    :param str model_version: pedsnet model version, e.g. 2.3.0 (not
+                              used by the era derivation)
     :param str id_name: name of the id (ex. dcc or onco)
     :param bool notable: if True, don't run derivation
     :param bool nopk: if True, don't add primary key
-    :param bool novac: if True, don't vacuum
+    :param bool novac: if True, don't analyze
     :returns:                 True if the function succeeds
     :rtype:                   bool
     :raises DatabaseError:    if any of the statement executions cause errors
@@ -541,88 +519,68 @@ def run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept, search_
     start_time = time.time()
     schema = primary_schema(search_path)
 
-    stmts = StatementSet()
-
-    if era_type != "drug_scdf" and not no_ids:
-        # Drop primary key.
-        drop_pk_stmt = Statement(DROP_PK_CONSTRAINT_ERA_SQL.format(era_type))
-        stmts.add(drop_pk_stmt)
-
-        # Check for any errors and raise exception if they are found.
-        for stmt in stmts:
-            try:
-                stmt.execute(conn_str)
-                check_stmt_err(stmt, logger_msg.format('Run', era_type))
-            except:
-                logger.error(combine_dicts({'msg': 'Fatal error',
-                                            'sql': stmt.sql,
-                                            'err': str(stmt.err)}, log_dict))
-                logger.info(combine_dicts({'msg': 'drop pk failed',
-                                           'elapsed': secs_since(start_time)},
-                                          log_dict))
-                raise
-
-        # Add drop null statement.
-        stmts.clear()
-        drop_stmt = Statement(DROP_NULL_ERA_SQL.format(era_type))
-        stmts.add(drop_stmt)
-
-        # Check for any errors and raise exception if they are found.
-        for stmt in stmts:
-            try:
-                stmt.execute(conn_str)
-                check_stmt_err(stmt, logger_msg.format('Run', era_type))
-            except:
-                logger.error(combine_dicts({'msg': 'Fatal error',
-                                            'sql': stmt.sql,
-                                            'err': str(stmt.err)}, log_dict))
-                logger.info(combine_dicts({'msg': 'drop null failed',
-                                           'elapsed': secs_since(start_time)},
-                                          log_dict))
-                raise
-
-   # Run the derivation query
-    if not notable:
-        logger.info({'msg': 'run {0} era derivation query'.format(era_type)})
-        run_query_msg = "running {0} era derivation query"
-
-        # run query
-        stmts.clear()
-        if era_type == "condition":
-            era_query_stmt = Statement(CONDITION_ERA_SQL.format(schema, site), run_query_msg.format(era_type))
-        elif era_type == "drug_scdf":
-            era_query_stmt = Statement(DRUG_ERA_SCDF_SQL.format(schema, "vocabulary", site),
+    # The eras are derived into a temp table and counted first, then a block
+    # of ids is reserved for them in its own short transaction, and the
+    # staged eras are inserted with the drop primary key and drop null steps
+    # batched in front: one round trip, run by the server as one
+    # transaction. Both batches run on one connection so the insert can read
+    # the temp table.
+    conn = psycopg2.connect(conn_str)
+    try:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        steps = []
+        batch_sql = []
+        old_last_id = None
+        if era_type != "drug_scdf" and not no_ids:
+            steps.extend(['drop pk', 'drop null'])
+            batch_sql.append(DROP_PK_CONSTRAINT_ERA_SQL.format(era_type))
+            batch_sql.append(DROP_NULL_ERA_SQL.format(era_type))
+
+        if not notable:
+            derivation_sql, insert_sql = _derivation_sql(era_type, schema,
+                                                         not no_concept)
+            logger.info({'msg': 'run {0} era derivation query'.format(era_type)})
+            run_query_msg = "running {0} era derivation query"
+            era_query_stmt = Statement(derivation_sql,
                                        run_query_msg.format(era_type))
-        else:
-            era_query_stmt = Statement(DRUG_ERA_SQL.format(schema, "vocabulary", site), run_query_msg.format(era_type))
-
-        # Execute the query and ensure it didn't error
-        era_query_stmt.execute(conn_str)
-        check_stmt_err(era_query_stmt, 'run {0} era derivation query'.format(era_type))
-        logger.info({'msg': '{0} era derivation query complete'.format(era_type)})
-
-
-    # add ids
-    if not no_ids:
-        okay = _add_era_ids(era_type, conn_str, site, neg_ids, search_path, model_version, id_name)
-        if not okay:
-            return False
-
-    # Add the concept_names
-    if not no_concept:
-        logger.info({'msg': 'add concept names'})
-        okay = _fill_concept_names(conn_str, era_type, site)
-        if not okay:
-            return False
-        logger.info({'msg': 'concept names added'})
-
-    # Copy drug_scdf era to drug era
-    if era_type == "drug_scdf":
-        logger.info({'msg': 'copy drug_scdf_era to {0}.drug_era'.format(schema)})
-        okay = _copy_to_drug_era_table(conn_str, schema)
-        if not okay:
-            return False
-        logger.info({'msg': 'drug_scdf_era copied to {0}.drug_era'.format(schema)})
+            era_query_stmt.execute_on_conn(conn)
+            check_stmt_err(era_query_stmt, 'run {0} era derivation query'.format(era_type))
+            check_stmt_data(era_query_stmt, 'run {0} era derivation query'.format(era_type))
+            era_count = era_query_stmt.data[0][0]
+            logger.info({'msg': '{0} era derivation query complete'.format(era_type),
+                         'count': era_count})
+
+            # Era ids and concept names are written by the insert.
+            if not no_ids and era_count:
+                old_last_id = _reserve_era_ids(era_type, conn_str, id_name,
+                                               era_count, neg_ids)
+            steps.append('insert')
+            batch_sql.append(insert_sql)
+
+        # SCDF eras are merged into drug_era in the same transaction. The
+        # drug_scdf_era table is dropped there too, unless the dcc_pedsnet
+        # copy still has to read it.
+        drop_scdf = era_type == "drug_scdf" and not copy
+        if era_type == "drug_scdf":
+            steps.append('copy to drug_era')
+            batch_sql.append(COPY_TO_DRUG_ERA_SQL.format(schema))
+        if drop_scdf:
+            steps.append('drug_scdf drop')
+            batch_sql.append(drop_drug_scdf_era_sql.format(schema))
+
+        if batch_sql:
+            logger.info({'msg': 'run {0} era insert query'.format(era_type),
+                         'steps': ', '.join(steps)})
+            insert_stmt = Statement('\n'.join(batch_sql),
+                                    'running {0} era insert query'.format(era_type),
+                                    params={'site': site,
+                                            'old_last_id': old_last_id})
+            insert_stmt.execute_on_conn(conn)
+            check_stmt_err(insert_stmt, 'run {0} era insert query'.format(era_type))
+            logger.info({'msg': '{0} era insert query complete'.format(era_type)})
+    finally:
+        conn.close()
 
     # Copy to the dcc_pedsnet table
     if copy:
@@ -632,21 +590,15 @@ def run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept, search_
             return False
         logger.info({'msg': '{0}_era copied to dcc_pedsnet'.format(era_type)})
 
-    if era_type == "drug_scdf":
+    if era_type == "drug_scdf" and not drop_scdf:
         # Drop drug_scdf era to drug era
         logger.info({'msg': 'begin drug_scdf drop'})
         drop_drug_scdf_era_stmt = Statement(drop_drug_scdf_era_sql.format(schema),
                                             drop_drug_scdf_era_msg.format(schema))
         drop_drug_scdf_era_stmt.execute(conn_str)
+        check_stmt_err(drop_drug_scdf_era_stmt, 'drop drug_scdf_era')
         logger.info({'msg': 'drug_scdf dropped'})
 
-    if era_type != "condition":
-        # Renumber site_id
-        logger.info({'msg': 'begin drug_era_renumbering'})
-        _renumber_drug_era_table(conn_str, schema)
-        logger.info({'msg': 'finished drug_era_renumbering'})
-
-
     # Add primary keys
     if not nopk:
         if era_type != "drug_scdf":
@@ -656,11 +608,20 @@ def run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept, search_
     if era_type == "drug_scdf":
         era_table = "drug_era"
 
-    # Vacuum analyze tables for piney freshness.
+    # Analyze tables for piney freshness. The era tables are only truncated
+    # and inserted into, leaving no dead rows to vacuum, so they just need
+    # their statistics.
     if not novac:
-        logger.info({'msg': 'begin vacuum'})
-        vacuum(conn_str, model_version, analyze=True, tables=[era_table])
-        logger.info({'msg': 'vacuum finished'})
+        logger.info({'msg': 'begin analyze'})
+        analyze_tables = ['{0}.{1}'.format(schema, era_table)]
+        if copy:
+            analyze_tables.append('dcc_pedsnet.' + _COPY_TO_DCC[era_type][1])
+        for table in analyze_tables:
+            analyze_stmt = Statement('ANALYZE {0}'.format(table),
+                                     'analyzing {0}'.format(table))
+            analyze_stmt.execute(conn_str)
+            check_stmt_err(analyze_stmt, 'analyze {0}'.format(table))
+        logger.info({'msg': 'analyze finished'})
 
     # Log end of function.
     logger.info(combine_dicts({'msg': logger_msg.format("finished",era_type),
@@ -670,177 +631,148 @@ def run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept, search_
     return True
 
 
-def _add_primary_key(era_type, conn_str, schema):
-    # Add primary keys
-    pk_era_id_sql = "alter table {0}.{1}_era add primary key ({2}_era_id)"
-    pk_era_id_msg = "making {0}_era_id the primary key"
-    temp_era_type = era_type
-    if era_type == 'drug_scdf':
-        temp_era_type = 'drug'
+def run_era_chains(chains, conn_str, site, copy, neg_ids, no_ids, no_concept, search_path, model_version,
+                   id_name):
+    """Run chains of era derivations, each chain in its own thread.
 
-    # Make era Id the primary key
-    logger.info({'msg': 'begin add primary key'})
-    pk_era_id_stmt = Statement(pk_era_id_sql.format(schema, era_type, temp_era_type),
-                               pk_era_id_msg.format(temp_era_type))
-
-    # Execute the make era Id the primary key statement and ensure it didn't error
-    pk_era_id_stmt.execute(conn_str)
-    check_stmt_err(pk_era_id_stmt, 'make {0}_era_id the primary key'.format(era_type))
-    logger.info({'msg': 'primary key created'})
-
-    # If reached without error, then success!
-    return True
-
-
-def _add_era_ids(era_type, conn_str, site, neg_ids, search_path, model_version, id_name):
-    """Add ids for the era table
+    The era types within a chain are run in order (e.g. drug_scdf has to
+    follow drug, as it is merged into drug_era), while separate chains touch
+    separate tables and id ranges and run concurrently, each on its own
+    database connections. Once one chain fails, the others stop before
+    their next era type. The primary keys are added after every chain has
+    finished, so the concurrent index builds don't wait on another chain's
+    derivation transaction.
 
-    * Find how many ids needed
-    * Update dcc_id with new value
-    * Create sequence
-    * Set sequence starting number
-    * Assign era ids
-    * Make era Id the primary key
-
-    :param str era_type:      type of era derivation (condition or drug)
+    :param list chains:     lists of era types, e.g. [['drug', 'drug_scdf'],
+                            ['condition']]
     :param str conn_str:      database connection string
     :param str site:    site to run derivation for
+    :param bool copy: if True, copy results to dcc_pedsnet
+    :param bool neg_ids: if True, use negative ids (the id range has to
+                         stay <= 0)
+    :param bool no_ids: if True, don't assign ids
+    :param bool no_concept: if True, don't add concept names
     :param str search_path: PostgreSQL schema search path
-    :param str model_version: pedsnet model version, e.g. 2.3.0
+    :param str model_version: pedsnet model version, e.g. 2.3.0 (not
+                              used by the era derivation)
     :param str id_name: name of the id (ex. dcc or onco)
-    :returns:                 True if the function succeeds
+    :returns:                 True if every chain succeeds
     :rtype:                   bool
     :raises DatabaseError:    if any of the statement executions cause errors
     """
 
-    new_id_count_sql = """SELECT COUNT(*)
-        FROM {0}_era WHERE {1}_era_id IS NULL"""
-    new_id_count_msg = "counting new IDs needed for {0}_era"
-    lock_last_id_sql = """LOCK {last_id_table_name}"""
-    lock_last_id_msg = "locking {table_name} last ID tracking table for update"
-
-    update_last_id_sql = """UPDATE {last_id_table_name} AS new
-        SET last_id = new.last_id + '{new_id_count}'::bigint
-        FROM {last_id_table_name} AS old RETURNING old.last_id, new.last_id"""
-    update_last_id_msg = "updating {table_name} last ID tracking table to reserve new IDs"  # noqa
-    create_seq_sql = "create sequence if not exists {0}.{1}_{2}_era_id_seq"
-    create_neg_seq_sql = """create sequence if not exists {0}.{1}_{2}_era_id_seq
-        INCREMENT 1 START -2147483647 MINVALUE -2147483647 MAXVALUE 0"""
-    create_seq_msg = "creating {0} era id sequence"
-    set_seq_number_sql = "alter sequence {0}.{1}_{2}_era_id_seq restart with {3};"
-    set_seq_number_msg = "setting sequence number"
-    add_era_ids_sql = """update {0}.{1}_era set {3}_era_id = nextval('{0}.{2}_{1}_era_id_seq')
-        where {3}_era_id is null"""
-    add_era_ids_msg = "adding the era ids to the {0}_era table"
+    results = [None] * len(chains)
+    errors = [None] * len(chains)
+    failed = threading.Event()
+
+    def _run_chain(index, chain):
+        try:
+            for era_type in chain:
+                if failed.is_set():
+                    results[index] = False
+                    return
+                results[index] = run_era(era_type, conn_str, site, copy, neg_ids, no_ids, no_concept,
+                                         search_path, model_version, id_name, nopk=True)
+                if not results[index]:
+                    failed.set()
+                    return
+        except Exception as err:
+            errors[index] = err
+            failed.set()
+
+    threads = [threading.Thread(target=_run_chain, args=(index, chain))
+               for index, chain in enumerate(chains)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Reraise the first error once every chain has stopped.
+    for err in errors:
+        if err is not None:
+            raise err
+
+    if not all(results):
+        return False
 
-    conn_info_dict = get_conn_info_dict(conn_str)
+    # Add primary keys
+    schema = primary_schema(search_path)
+    for chain in chains:
+        for era_type in chain:
+            if era_type != "drug_scdf":
+                _add_primary_key(era_type, conn_str, schema)
 
-    # Log start of the function and set the starting time.
-    log_dict = combine_dicts({'site': site, },
-                             conn_info_dict)
+    return True
 
-    logger = logging.getLogger(__name__)
 
-    logger.info(combine_dicts({'msg': 'starting id assignment'},
-                              log_dict))
-    start_time = time.time()
-    schema = primary_schema(search_path)
-    table_name = era_type + "_era"
-    temp_table_name = table_name
+def _execute_with_lock_retry(stmt, conn_str):
+    """Execute a statement, retrying it while it fails on lock contention
+
+    Lock timeouts, serialization failures and deadlocks are retried up to
+    LOCK_RETRY_ATTEMPTS times, waiting 1, 2, 4... seconds in between. Any
+    other error (or the last contention error) is left in stmt.err. A
+    retry re-runs the whole statement, so this is only used for the short
+    id reservation and primary key promotion.
+
+    :param Statement stmt: the statement to execute
+    :param str conn_str:   database connection string
+    :returns:              the executed statement
+    :rtype:                Statement
+    """
+    for attempt in range(LOCK_RETRY_ATTEMPTS):
+        stmt.execute(conn_str)
+        if getattr(stmt.err, 'pgcode', None) not in LOCK_RETRY_PGCODES:
+            break
+        if attempt + 1 < LOCK_RETRY_ATTEMPTS:
+            logger.warning({'msg': 'lock contention, retrying',
+                            'sql_msg': stmt.msg, 'attempt': attempt + 1,
+                            'err': str(stmt.err)})
+            time.sleep(2 ** attempt)
+    return stmt
+
+
+def _add_primary_key(era_type, conn_str, schema):
+    # Add primary keys
+    has_pk_sql = """SELECT 1 FROM pg_constraint
+        WHERE conrelid = %(table)s::regclass AND contype = 'p'"""
+    has_pk_msg = "checking for a {0}_era primary key"
+    # Build the unique index without blocking the table, then promote it;
+    # the exclusive lock is only held for the constraint swap. A leftover
+    # invalid index from an interrupted build is dropped first.
+    pk_era_idx_sql = """DROP INDEX CONCURRENTLY IF EXISTS {0}.{1}_era_pkey_idx"""
+    pk_era_idx_create_sql = """CREATE UNIQUE INDEX CONCURRENTLY {1}_era_pkey_idx
+        ON {0}.{1}_era ({2}_era_id)"""
+    pk_era_idx_msg = "building the {0}_era_id unique index"
+    pk_era_id_sql = """alter table {0}.{1}_era add constraint {1}_era_pkey
+        primary key using index {1}_era_pkey_idx"""
+    pk_era_id_msg = "making {0}_era_id the primary key"
     temp_era_type = era_type
     if era_type == 'drug_scdf':
         temp_era_type = 'drug'
-        temp_table_name = 'drug_era'
-
-    # Mapping and last ID table naming conventions.
-    last_id_table_name_tmpl = id_name + "_{table_name}_id"
-    metadata = stock_metadata(model_version)
-
-    # Get table object and start to build tpl_vars map, which will be
-    # used throughout for formatting SQL statements.
-    table = metadata.tables[temp_table_name]
-    tpl_vars = {'table_name': temp_table_name}
-    tpl_vars['last_id_table_name'] = last_id_table_name_tmpl.format(**tpl_vars)
-
-    # Build the statement to count how many new ID mappings are needed.
-    new_id_count_stmt = Statement(new_id_count_sql.format(era_type, temp_era_type), new_id_count_msg.format(era_type))
-
-    # Execute the new ID mapping count statement and ensure it didn't
-    # error and did return a result.
-    new_id_count_stmt.execute(conn_str)
-    check_stmt_err(new_id_count_stmt, 'assign ids')
-    check_stmt_data(new_id_count_stmt, 'assign ids')
-
-    # Get the actual count of new ID maps needed and log it.
-    tpl_vars['new_id_count'] = new_id_count_stmt.data[0][0]
-    logger.info({'msg': 'counted new IDs needed', 'table': table_name,
-                 'count': tpl_vars['new_id_count']})
-
-    # Build list of two last id table update statements that need to
-    # occur in a single transaction to prevent race conditions.
-    update_last_id_stmts = StatementList()
-    update_last_id_stmts.append(Statement(
-        lock_last_id_sql.format(**tpl_vars),
-        lock_last_id_msg.format(**tpl_vars)))
-    update_last_id_stmts.append(Statement(
-        update_last_id_sql.format(**tpl_vars),
-        update_last_id_msg.format(**tpl_vars)))
-
-    # Execute last id table update statements and ensure they didn't
-    # error and the second one returned results.
-    update_last_id_stmts.serial_execute(conn_str, transaction=True)
-
-    for stmt in update_last_id_stmts:
-        check_stmt_err(stmt, 'assign ids')
-    check_stmt_data(update_last_id_stmts[1],
-                    'assign ids')
-
-    # Get the old and new last IDs from the second update statement.
-    tpl_vars['old_last_id'] = update_last_id_stmts[1].data[0][0]
-    tpl_vars['new_last_id'] = update_last_id_stmts[1].data[0][1]
-    logger.info({'msg': 'last ID tracking table updated',
-                 'table': temp_table_name,
-                 'old_last_id': tpl_vars['old_last_id'],
-                 'new_last_id': tpl_vars['new_last_id']})
-
-    logger.info({'msg': 'begin id sequence creation'})
-
-    # Create the id sequence (if it doesn't exist)
-    if neg_ids:
-        era_seq_stmt = Statement(create_neg_seq_sql.format(schema, site, era_type),
-                                 create_seq_msg.format(era_type))
-    else:
-        era_seq_stmt = Statement(create_seq_sql.format(schema, site, era_type),
-                                 create_seq_msg.format(era_type))
-
-    # Execute the create the era id sequence statement and ensure it didn't error
-    era_seq_stmt.execute(conn_str)
-    check_stmt_err(era_seq_stmt, 'create {0} era id sequence'.format(era_type))
-    logger.info({'msg': 'sequence creation complete'})
-
-    # Set the sequence number
-    logger.info({'msg': 'begin set sequence number'})
-    seq_number_set_stmt = Statement(set_seq_number_sql.format(schema, site, era_type, tpl_vars['old_last_id']),
-                                    set_seq_number_msg)
-
-    # Execute the set the sequence number statement and ensure it didn't error
-    seq_number_set_stmt.execute(conn_str)
-    check_stmt_err(seq_number_set_stmt, 'set the sequence number')
-    logger.info({'msg': 'set sequence number complete'})
-
-    # Add the era ids
-    logger.info({'msg': 'begin adding ids'})
-    add_era_ids_stmt = Statement(add_era_ids_sql.format(schema, era_type, site, temp_era_type),
-                                         add_era_ids_msg.format(era_type))
-
-    # Execute the add the era ids statement and ensure it didn't error
-    add_era_ids_stmt.execute(conn_str)
-    check_stmt_err(add_era_ids_stmt, 'add the {0} era ids'.format(era_type))
-    logger.info({'msg': 'add {0} era ids complete'.format(era_type)})
 
-    # Log end of function.
-    logger.info(combine_dicts({'msg': 'finished adding {0} era ids for the {0}_era table'.format(era_type),
-                               'elapsed': secs_since(start_time)}, log_dict))
+    # Leave an existing primary key (e.g. kept by a no ids run) in place.
+    has_pk_stmt = Statement(has_pk_sql, has_pk_msg.format(era_type),
+                            params={'table': '{0}.{1}_era'.format(schema, era_type)})
+    has_pk_stmt.execute(conn_str)
+    check_stmt_err(has_pk_stmt, 'check for {0}_era primary key'.format(era_type))
+    if has_pk_stmt.data:
+        logger.info({'msg': '{0}_era primary key already exists'.format(era_type)})
+        return True
+
+    # Make era Id the primary key
+    logger.info({'msg': 'begin add primary key'})
+    for sql in (pk_era_idx_sql, pk_era_idx_create_sql):
+        pk_era_idx_stmt = Statement(sql.format(schema, era_type, temp_era_type),
+                                    pk_era_idx_msg.format(temp_era_type))
+        pk_era_idx_stmt.execute(conn_str)
+        check_stmt_err(pk_era_idx_stmt, 'build {0}_era_id unique index'.format(era_type))
+    pk_era_id_stmt = Statement(LOCK_TIMEOUT_SQL + pk_era_id_sql.format(schema, era_type, temp_era_type),
+                               pk_era_id_msg.format(temp_era_type))
+
+    # Execute the make era Id the primary key statement and ensure it didn't error
+    _execute_with_lock_retry(pk_era_id_stmt, conn_str)
+    check_stmt_err(pk_era_id_stmt, 'make {0}_era_id the primary key'.format(era_type))
+    logger.info({'msg': 'primary key created'})
 
     # If reached without error, then success!
     return True
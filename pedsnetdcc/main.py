@@ -918,8 +918,9 @@ def run_derivations(pwprompt, searchpath, site, copy, noids, noindexes, noconcep
       - Run BMIZ.
       - Run HeightZ.
       - Run WeightZ
-      - Run Drug Era
-      - Run Condition Era
+      - Run Drug Era (then Drug SCDF Era) and Condition Era concurrently
+        (a failure in one stops the other after its current era), then
+        add the era primary keys
 
     The database should be specified using a DBURI:
 
@@ -981,17 +982,10 @@ def run_derivations(pwprompt, searchpath, site, copy, noids, noindexes, noconcep
     if not success:
         sys.exit(1)
 
-    from pedsnetdcc.era import run_era
-    success = run_era("drug", conn_str, site, copy, neg_ids, no_ids, no_concept, searchpath, model_version, idname)
-
-    if not success:
-        sys.exit(1)
-
-    success = run_era("drug_scdf", conn_str, site, copy, neg_ids, no_ids, no_concept, searchpath, model_version, idname)
-    if not success:
-        sys.exit(1)
-
-    success = run_era("condition", conn_str, site, copy, neg_ids, no_ids, no_concept, searchpath, model_version, idname)
+    # Drug eras (then drug_scdf eras) and condition eras run concurrently.
+    from pedsnetdcc.era import run_era_chains
+    success = run_era_chains([["drug", "drug_scdf"], ["condition"]], conn_str, site, copy, neg_ids, no_ids,
+                             no_concept, searchpath, model_version, idname)
 
     if not success:
         sys.exit(1)
@@ -2016,8 +2010,9 @@ def run_drug_condition_era(pwprompt, searchpath, site, copy, neg_ids, no_ids, no
 
     The steps are:
 
-      - Run Drug Era
-      - Run Condition Era
+      - Run Drug Era and Condition Era concurrently
+        (a failure in one stops the other after its current era), then
+        add the era primary keys
 
     The database should be specified using a DBURI:
 
@@ -2032,14 +2027,10 @@ def run_drug_condition_era(pwprompt, searchpath, site, copy, neg_ids, no_ids, no
 
     conn_str = make_conn_str(dburi, searchpath, password)
 
-    from pedsnetdcc.era import run_era
-    success = run_era("drug", conn_str, site, copy, neg_ids, no_ids, no_concept, searchpath, model_version, idname)
-
-    if not success:
-        sys.exit(1)
-
-    from pedsnetdcc.era import run_era
-    success = run_era("condition", conn_str, site, copy, neg_ids, no_ids, no_concept, searchpath, model_version, idname)
+    # Drug and condition eras run concurrently.
+    from pedsnetdcc.era import run_era_chains
+    success = run_era_chains([["drug"], ["condition"]], conn_str, site, copy, neg_ids, no_ids, no_concept,
+                             searchpath, model_version, idname)
 
     if not success:
         sys.exit(1)
@@ -2,13 +2,15 @@ import json
 import logging
 import multiprocessing
 import psycopg2
+import tempfile
 import testing.postgresql
 import threading
 import unittest
 
 from pedsnetdcc.db import (Statement, StatementSet, StatementList,
                            _worker_process, _logger_thread)
-from pedsnetdcc.dict_logging import DictLogFilter, DictQueueHandler
+from pedsnetdcc.dict_logging import (DictLogFilter, DictQueueHandler,
+                                     BatchingDictQueueHandler)
 from pedsnetdcc.utils import make_conn_str
 
 Postgresql = None
@@ -295,6 +297,88 @@ class StatementTest(unittest.TestCase):
         self.assertEqual(result, 1)
         self.assertEqual(fieldname, 'foo')
 
+    def test_execute_itersize(self):
+
+        conn = None
+
+        try:
+            with psycopg2.connect(self.conn_str) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('CREATE TABLE test (foo int)')
+                    cursor.execute('INSERT INTO test '
+                                   'SELECT generate_series(1, 25)')
+        finally:
+            if conn:
+                conn.close()
+
+        stmt = Statement('SELECT foo FROM test ORDER BY foo', itersize=10)
+        stmt.execute(self.conn_str)
+
+        self.assertIsNone(stmt.err)
+        self.assertEqual([row[0] for row in stmt.data], list(range(1, 26)))
+        self.assertEqual(stmt.fields, ['foo'])
+        self.assertEqual(stmt.rowcount, 25)
+
+    def test_execute_itersize_sink(self):
+
+        conn = None
+
+        try:
+            with psycopg2.connect(self.conn_str) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('CREATE TABLE test (foo int)')
+                    cursor.execute('INSERT INTO test '
+                                   'SELECT generate_series(1, 25)')
+        finally:
+            if conn:
+                conn.close()
+
+        batches = []
+        stmt = Statement('SELECT foo FROM test ORDER BY foo', itersize=10,
+                         sink=batches.append)
+        stmt.execute(self.conn_str)
+
+        self.assertIsNone(stmt.err)
+        self.assertIsNone(stmt.data)
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual([row[0] for batch in batches for row in batch],
+                         list(range(1, 26)))
+        self.assertEqual(stmt.rowcount, 25)
+
+    def test_execute_params(self):
+
+        stmt = Statement('SELECT %(a)s::int + %(b)s::int AS total',
+                         params={'a': 1, 'b': 2})
+        stmt.execute(self.conn_str)
+
+        self.assertIsNone(stmt.err)
+        self.assertEqual(stmt.data[0][0], 3)
+        self.assertEqual(stmt.fields, ['total'])
+
+    def test_execute_copy_to(self):
+
+        conn = None
+        out = tempfile.TemporaryFile(mode='w+')
+        stmt = Statement('SELECT foo FROM test ORDER BY foo')
+
+        try:
+            with psycopg2.connect(self.conn_str) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('CREATE TABLE test (foo int)')
+                    cursor.execute('INSERT INTO test VALUES (1), (2)')
+                stmt.execute_copy_to(conn, out)
+            out.seek(0)
+            lines = out.read().splitlines()
+        finally:
+            out.close()
+            if conn:
+                conn.close()
+
+        self.assertIsNone(stmt.err)
+        self.assertIsNone(stmt.data)
+        self.assertEqual(stmt.rowcount, 2)
+        self.assertEqual(lines, ['foo', '1', '2'])
+
     def test_execute_on_conn_error(self):
 
         conn = None
@@ -484,6 +568,57 @@ class LoggerThreadTest(unittest.TestCase):
         self.assertEqual(msg2['level'], 'error')
         self.assertTrue('time' in msg2)
 
+    def test_log_passing_with_args(self):
+
+        # Set up the thread logger.
+        logq = multiprocessing.Queue()
+        qh = DictQueueHandler(logq)
+        thread_logger = logging.getLogger('test_args_logger')
+        thread_logger.setLevel(logging.DEBUG)
+        thread_logger.addHandler(qh)
+
+        # Start the logging thread.
+        logp = threading.Thread(target=_logger_thread, args=(logq,))
+        logp.start()
+
+        # Log a plain msg with format args.
+        thread_logger.warning('%d rows in %s', 3, 'foo')
+
+        # End the logging thread.
+        logq.put(None)
+        logp.join()
+
+        self.assertEqual(handler.messages['warning'], ['3 rows in foo'])
+
+    def test_batched_log_passing(self):
+
+        # Set up the thread logger with a batching handler.
+        logq = multiprocessing.Queue()
+        qh = BatchingDictQueueHandler(logq, batch_size=2)
+        thread_logger = logging.getLogger('test_batched_logger')
+        thread_logger.setLevel(logging.DEBUG)
+        thread_logger.addHandler(qh)
+
+        # Start the logging thread.
+        logp = threading.Thread(target=_logger_thread, args=(logq,))
+        logp.start()
+
+        # Log a full batch plus one record left for the flush.
+        thread_logger.info({'msg': 'foo'})
+        thread_logger.info({'msg': 'bar'})
+        thread_logger.error({'msg': 'baz'})
+        qh.flush()
+
+        # End the logging thread.
+        logq.put(None)
+        logp.join()
+
+        # Check logged messages match expected and arrived in order.
+        msgs = [json.loads(m)['msg'] for m in handler.messages['info']]
+        self.assertEqual(msgs, ['foo', 'bar'])
+        msg3 = json.loads(handler.messages['error'][0])
+        self.assertEqual(msg3['msg'], 'baz')
+
 
 class MockExecutable(object):
     """Mock executable to simulate the Statement API without needing a DB."""
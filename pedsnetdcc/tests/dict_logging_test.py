@@ -0,0 +1,35 @@
+import logging
+import unittest
+
+from pedsnetdcc.dict_logging import DictLogFilter
+
+
+class DictLogFilterTest(unittest.TestCase):
+
+    def _text(self, msg):
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, msg,
+                                   None, None)
+        DictLogFilter('text').text_filter(record)
+        return record.msg
+
+    def test_text_filter(self):
+        out = self._text({'msg': 'done', 'table': 'drug_era'})
+
+        self.assertIn('msg="done"', out)
+        self.assertIn('table="drug_era"', out)
+        self.assertIn('level="info"', out)
+
+    def test_text_filter_escapes(self):
+        # Backslashes are escaped before quotes, so a value ending in a
+        # backslash can't escape its closing quote.
+        out = self._text({'msg': 'say "hi"', 'path': 'C:\\dir\\'})
+
+        self.assertIn('msg="say \\"hi\\""', out)
+        self.assertIn('path="C:\\\\dir\\\\"', out)
+
+    def test_text_filter_copies_msg(self):
+        # The caller's dict is left as it was.
+        msg = {'msg': 'done'}
+        self._text(msg)
+
+        self.assertEqual(msg, {'msg': 'done'})
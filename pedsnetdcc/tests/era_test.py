@@ -0,0 +1,362 @@
+import psycopg2
+import testing.postgresql
+import unittest
+
+from pedsnetdcc.era import (_copy_to_dcc_table, _derivation_sql,
+                             _reserve_era_ids, run_era, run_era_chains)
+from pedsnetdcc.utils import DatabaseError, make_conn_str
+
+Postgresql = None
+
+# Minimal source, vocabulary and era tables for the derivation queries.
+SETUP_SQL = """
+CREATE SCHEMA s_pedsnet;
+CREATE SCHEMA vocabulary;
+CREATE TABLE vocabulary.concept (concept_id int PRIMARY KEY,
+    concept_name text, vocabulary_id text, concept_class_id text);
+CREATE TABLE vocabulary.concept_ancestor (ancestor_concept_id int,
+    descendant_concept_id int);
+CREATE TABLE s_pedsnet.condition_occurrence (person_id int,
+    condition_concept_id int, condition_start_date date,
+    condition_end_date date);
+CREATE TABLE s_pedsnet.drug_exposure (person_id int, drug_concept_id int,
+    drug_type_concept_id int, drug_exposure_start_date date,
+    drug_exposure_end_date date, days_supply int);
+CREATE TABLE s_pedsnet.condition_era (condition_concept_id int,
+    condition_era_end_date date, condition_era_start_date date,
+    condition_occurrence_count int, condition_concept_name text, site text,
+    condition_era_id bigint, site_id bigint, person_id int);
+CREATE TABLE s_pedsnet.drug_era (drug_concept_id int, drug_era_end_date date,
+    drug_era_start_date date, drug_exposure_count int, gap_days int,
+    drug_concept_name text, site text, drug_era_id bigint, site_id bigint,
+    person_id int);
+CREATE TABLE s_pedsnet.dcc_condition_era_id (last_id bigint);
+CREATE TABLE s_pedsnet.dcc_drug_era_id (last_id bigint);
+INSERT INTO s_pedsnet.dcc_condition_era_id VALUES (1000);
+INSERT INTO s_pedsnet.dcc_drug_era_id VALUES (500);
+INSERT INTO vocabulary.concept VALUES
+    (10, 'Asthma', 'SNOMED', 'Clinical Finding'),
+    (100, 'albuterol', 'RxNorm', 'Ingredient'),
+    (200, 'albuterol Inhalant Solution', 'RxNorm', 'Clinical Drug Form'),
+    (300, 'albuterol 0.83 MG/ML Inhalant Solution', 'RxNorm',
+     'Clinical Drug');
+INSERT INTO vocabulary.concept_ancestor VALUES (100, 300), (200, 300);
+-- two occurrences within 30 days of each other, then one much later
+INSERT INTO s_pedsnet.condition_occurrence VALUES
+    (1, 10, '2020-01-01', '2020-01-05'),
+    (1, 10, '2020-01-20', NULL),
+    (1, 10, '2020-05-01', '2020-05-02');
+INSERT INTO s_pedsnet.drug_exposure VALUES
+    (1, 300, 1, '2020-01-01', NULL, 10),
+    (1, 300, 1, '2020-01-25', '2020-02-01', NULL),
+    (1, 300, 1, '2020-06-01', NULL, NULL);
+"""
+
+
+def setUpModule():
+
+    # Generate a Postgresql class which caches the init-ed database across
+    # multiple ephemeral database cluster instances.
+    global Postgresql
+    Postgresql = testing.postgresql.PostgresqlFactory(
+        cache_initialized_db=True)
+
+
+def tearDownModule():
+    # Clear cached init-ed database at end of tests.
+    Postgresql.clear_cache()
+
+
+class EraSqlTest(unittest.TestCase):
+
+    def test_templates_format(self):
+        # Every placeholder in the era templates is filled and no stray
+        # braces are left behind.
+        formatted = []
+        for era_type in ('condition', 'drug', 'drug_scdf'):
+            formatted.extend(_derivation_sql(era_type, 's_pedsnet'))
+            formatted.extend(_derivation_sql(era_type, 's_pedsnet',
+                                             concept_names=False))
+        for sql in formatted:
+            self.assertNotIn('{', sql)
+            self.assertNotIn('}', sql)
+
+    def test_derivation_sql_cached(self):
+        # The formatted derivation SQL is reused per era type and schema,
+        # with the site and ids left as query parameters of the insert.
+        sql = _derivation_sql('drug', 's_pedsnet')
+        self.assertIs(sql, _derivation_sql('drug', 's_pedsnet'))
+        derivation_sql, insert_sql = sql
+        self.assertIn('CREATE TEMP TABLE rxnorm_ingredient_map', derivation_sql)
+        self.assertNotIn('INSERT INTO', derivation_sql)
+        self.assertIn('%(site)s', insert_sql)
+        self.assertIn('%(old_last_id)s', insert_sql)
+        self.assertIsNot(sql, _derivation_sql('drug', 'other'))
+
+
+class EraDerivationTest(unittest.TestCase):
+
+    def setUp(self):
+        # Create a postgres database in a temp directory.
+        self.postgresql = Postgresql()
+        self.conn_str = make_conn_str(self.postgresql.url(),
+                                      's_pedsnet,vocabulary')
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(SETUP_SQL)
+        conn.close()
+
+    def tearDown(self):
+        # Destroy the postgres database.
+        self.postgresql.stop()
+
+    def _derive(self, era_type, query, id_name=None, concept_names=True):
+        # Stage the eras, reserve their ids, insert them and return query
+        # rows.
+        derivation_sql, insert_sql = _derivation_sql(era_type, 's_pedsnet',
+                                                     concept_names)
+        conn = psycopg2.connect(self.conn_str)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(derivation_sql)
+            count = cursor.fetchone()[0]
+            old_last_id = None
+            if id_name is not None:
+                old_last_id = _reserve_era_ids(era_type, self.conn_str,
+                                               id_name, count)
+            cursor.execute(insert_sql, {'site': 'test',
+                                        'old_last_id': old_last_id})
+            cursor.execute(query)
+            rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def test_condition_era(self):
+        rows = self._derive('condition', """SELECT person_id,
+            condition_concept_id, condition_era_start_date::text,
+            condition_era_end_date::text, condition_occurrence_count,
+            condition_concept_name, site FROM condition_era
+            ORDER BY condition_era_start_date""")
+
+        self.assertEqual(rows, [
+            (1, 10, '2020-01-01', '2020-01-21', 2, 'Asthma', 'test'),
+            (1, 10, '2020-05-01', '2020-05-02', 1, 'Asthma', 'test')])
+
+    def test_drug_era(self):
+        rows = self._derive('drug', """SELECT person_id, drug_concept_id,
+            drug_era_start_date::text, drug_era_end_date::text,
+            drug_exposure_count, gap_days, drug_concept_name, site
+            FROM drug_era ORDER BY drug_era_start_date""")
+
+        self.assertEqual(rows, [
+            (1, 100, '2020-01-01', '2020-02-01', 2, 30, 'albuterol', 'test'),
+            (1, 100, '2020-06-01', '2020-06-02', 1, 30, 'albuterol',
+             'test')])
+
+    def test_drug_scdf_era(self):
+        rows = self._derive('drug_scdf', """SELECT person_id,
+            drug_concept_id, drug_era_start_date::text,
+            drug_era_end_date::text, drug_exposure_count
+            FROM drug_scdf_era ORDER BY drug_era_start_date""")
+
+        self.assertEqual(rows, [
+            (1, 200, '2020-01-01', '2020-02-01', 2),
+            (1, 200, '2020-06-01', '2020-06-02', 1)])
+
+    def test_era_ids(self):
+        # Ids come from the reserved range, in site_id order, and the last
+        # ID tracking table is moved past them.
+        rows = self._derive('condition', """SELECT condition_era_id, site_id
+            FROM condition_era ORDER BY site_id""", 'dcc')
+        self.assertEqual(rows, [(1000, 1), (1001, 2)])
+
+        rows = self._derive('drug', """SELECT drug_era_id FROM drug_era
+            UNION ALL SELECT last_id FROM dcc_drug_era_id""", 'dcc')
+        self.assertEqual(sorted(rows), [(500,), (501,), (502,)])
+
+        rows = self._derive('drug', "SELECT drug_era_id FROM drug_era")
+        self.assertEqual(rows, [(None,), (None,)])
+
+    def test_concept_names(self):
+        # drug_scdf eras are named from the SCDF concept; without concept
+        # names only the site is filled in.
+        rows = self._derive('drug_scdf', """SELECT drug_concept_name, site
+            FROM drug_scdf_era""")
+        self.assertEqual(set(rows), {('albuterol Inhalant Solution',
+                                      'test')})
+
+        rows = self._derive('condition', """SELECT condition_concept_name,
+            site FROM condition_era""", concept_names=False)
+        self.assertEqual(set(rows), {(None, 'test')})
+
+    def test_run_era(self):
+        # The eras are derived, the primary key dropped and the eras
+        # inserted with ids, then analyzed.
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("ALTER TABLE condition_era ADD CONSTRAINT "
+                               "xpk_condition_era PRIMARY KEY "
+                               "(condition_era_id)")
+        conn.close()
+
+        self.assertTrue(run_era('condition', self.conn_str, 'test', False,
+                                False, False, False, 's_pedsnet,vocabulary',
+                                '2.3.0', 'dcc', nopk=True))
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_constraint WHERE "
+                               "conrelid = 'condition_era'::regclass")
+                self.assertEqual(cursor.fetchone()[0], 0)
+                cursor.execute("SELECT condition_era_id, condition_concept_name"
+                               " FROM condition_era ORDER BY 1")
+                self.assertEqual(cursor.fetchall(), [(1000, 'Asthma'),
+                                                     (1001, 'Asthma')])
+                cursor.execute("SELECT reltuples FROM pg_class "
+                               "WHERE oid = 'condition_era'::regclass")
+                self.assertEqual(cursor.fetchone()[0], 2)
+        conn.close()
+
+    def test_run_era_primary_key(self):
+        # The primary key is added after the eras are inserted, and a second
+        # run drops and adds it again.
+        for last_ids in ([(1000,), (1001,)], [(1002,), (1003,)]):
+            self.assertTrue(run_era('condition', self.conn_str, 'test',
+                                    False, False, False, False,
+                                    's_pedsnet,vocabulary', '2.3.0', 'dcc'))
+
+            with psycopg2.connect(self.conn_str) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT conname, contype FROM pg_constraint "
+                                   "WHERE conrelid = "
+                                   "'condition_era'::regclass")
+                    self.assertEqual(cursor.fetchall(),
+                                     [('condition_era_pkey', 'p')])
+                    cursor.execute("SELECT condition_era_id FROM "
+                                   "condition_era ORDER BY 1")
+                    self.assertEqual(cursor.fetchall(), last_ids)
+            conn.close()
+
+    def test_run_era_copy(self):
+        # The condition eras are copied to dcc_pedsnet, skipping ids that
+        # are already there.
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("CREATE SCHEMA dcc_pedsnet")
+                cursor.execute("CREATE TABLE dcc_pedsnet.condition_era "
+                               "(LIKE condition_era)")
+                cursor.execute("ALTER TABLE dcc_pedsnet.condition_era "
+                               "ADD PRIMARY KEY (condition_era_id)")
+                cursor.execute("INSERT INTO dcc_pedsnet.condition_era "
+                               "(condition_era_id, site) VALUES (1000, 'old')")
+        conn.close()
+
+        self.assertTrue(run_era('condition', self.conn_str, 'test', True,
+                                False, False, False, 's_pedsnet,vocabulary',
+                                '2.3.0', 'dcc', nopk=True))
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT condition_era_id, site, "
+                               "condition_concept_name FROM "
+                               "dcc_pedsnet.condition_era ORDER BY 1")
+                self.assertEqual(cursor.fetchall(),
+                                 [(1000, 'old', None),
+                                  (1001, 'test', 'Asthma')])
+        conn.close()
+
+    def test_copy_to_dcc_bounds(self):
+        # Only the site's ids already in dcc_pedsnet are skipped; other
+        # sites' ids below and above the site's id range are left alone.
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("CREATE SCHEMA dcc_pedsnet")
+                cursor.execute("CREATE TABLE dcc_pedsnet.drug_era "
+                               "(LIKE drug_era)")
+                cursor.execute("ALTER TABLE dcc_pedsnet.drug_era "
+                               "ADD PRIMARY KEY (drug_era_id)")
+                cursor.execute("INSERT INTO dcc_pedsnet.drug_era "
+                               "(drug_era_id, site) VALUES (1, 'other'), "
+                               "(501, 'old'), (9000, 'other')")
+                cursor.execute("INSERT INTO drug_era (drug_era_id, site) "
+                               "VALUES (500, 'test'), (501, 'test'), "
+                               "(502, 'test')")
+        conn.close()
+
+        self.assertTrue(_copy_to_dcc_table(self.conn_str, 'drug',
+                                           's_pedsnet'))
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT drug_era_id, site FROM "
+                               "dcc_pedsnet.drug_era ORDER BY 1")
+                self.assertEqual(cursor.fetchall(),
+                                 [(1, 'other'), (500, 'test'), (501, 'old'),
+                                  (502, 'test'), (9000, 'other')])
+        conn.close()
+
+    def test_run_era_neg_ids(self):
+        # Negative ids are only reserved while the whole block stays <= 0.
+        with self.assertRaises(ValueError):
+            run_era('condition', self.conn_str, 'test', False, True, False,
+                    False, 's_pedsnet,vocabulary', '2.3.0', 'dcc', nopk=True)
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT last_id FROM dcc_condition_era_id")
+                self.assertEqual(cursor.fetchone()[0], 1000)
+                cursor.execute("UPDATE dcc_condition_era_id "
+                               "SET last_id = -1")
+        conn.close()
+
+        self.assertTrue(run_era('condition', self.conn_str, 'test', False,
+                                True, False, False, 's_pedsnet,vocabulary',
+                                '2.3.0', 'dcc', nopk=True))
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT condition_era_id FROM condition_era "
+                               "ORDER BY 1")
+                self.assertEqual(cursor.fetchall(), [(-1,), (0,)])
+        conn.close()
+
+    def test_run_era_drug_scdf(self):
+        # SCDF eras merged into drug_era get ids and site_ids after the drug
+        # eras', and the drug_scdf_era table is dropped.
+        for era_type in ('drug', 'drug_scdf'):
+            self.assertTrue(run_era(era_type, self.conn_str, 'test', False,
+                                    False, False, False,
+                                    's_pedsnet,vocabulary', '2.3.0', 'dcc',
+                                    nopk=True))
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass('drug_scdf_era')")
+                self.assertIsNone(cursor.fetchone()[0])
+                cursor.execute("SELECT drug_concept_id, drug_era_id, site_id "
+                               "FROM drug_era ORDER BY drug_era_id")
+                rows = cursor.fetchall()
+        conn.close()
+        self.assertEqual(rows, [(100, 500, 1), (100, 501, 2), (200, 502, 3),
+                                (200, 503, 4)])
+
+    def test_run_era_chains_error(self):
+        # A failing chain's error is reraised once every chain has
+        # stopped, and no primary keys are added.
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE dcc_condition_era_id")
+        conn.close()
+
+        with self.assertRaises(DatabaseError):
+            run_era_chains([['drug', 'drug_scdf'], ['condition']],
+                           self.conn_str, 'test', False, False, False, False,
+                           's_pedsnet,vocabulary', '2.3.0', 'dcc')
+
+        with psycopg2.connect(self.conn_str) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_constraint WHERE "
+                               "conrelid IN ('drug_era'::regclass, "
+                               "'condition_era'::regclass)")
+                self.assertEqual(cursor.fetchone()[0], 0)
+        conn.close()
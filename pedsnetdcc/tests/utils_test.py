@@ -6,6 +6,7 @@ import testing.postgresql
 
 from pedsnetdcc.db import Statement
 from pedsnetdcc.utils import (make_conn_str, get_conn_info_dict,
+                              _conn_info_cache,
                               conn_str_with_search_path, set_logged,
                               vacuum, stock_metadata)
 
@@ -200,6 +201,22 @@ class GetConnInfoDictTest(unittest.TestCase):
                     'dbname': 'adb', 'port': None, 'user': 'auser'}
         self.assertEqual(conn_info, expected)
 
+    def test_cached_conn_info_is_a_copy(self):
+        # Modifying a returned dict must not leak into later calls.
+        cstr = "host=ahost dbname=adb user=auser"
+        conn_info = get_conn_info_dict(cstr)
+        conn_info['site'] = 'asite'
+        expected = {'search_path': None, 'host': 'ahost',
+                    'dbname': 'adb', 'port': None, 'user': 'auser'}
+        self.assertEqual(get_conn_info_dict(cstr), expected)
+
+    def test_cached_conn_info_drops_password(self):
+        # Passwords are not kept in the cache keys.
+        cstr = "host=ahost dbname=adb user=auser password='a secret'"
+        get_conn_info_dict(cstr)
+        for key in _conn_info_cache:
+            self.assertNotIn('secret', key)
+
 
 class SetLoggedTest(unittest.TestCase):
 
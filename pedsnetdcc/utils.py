@@ -177,6 +177,15 @@ def conn_str_with_search_path(conn_str, search_path):
     return _make_conn_str(pair_dict)
 
 
+# Parsed connection info, keyed by connection string with any password taken
+# out. Statements log this on every execution, so each distinct string is
+# only parsed once; the cache is emptied once it holds _CONN_INFO_CACHE_SIZE
+# entries.
+_conn_info_cache = {}
+_CONN_INFO_CACHE_SIZE = 128
+_PASSWORD_RE = re.compile(r"password=('(?:[^'\\]|\\.)*'|\S*)")
+
+
 def get_conn_info_dict(conn_str):
     """Return the connection info form a libpq-compliant conn string as a dict.
 
@@ -184,6 +193,9 @@ def get_conn_info_dict(conn_str):
     regular expressions. If any of them are not found, the corresponding dict
     value will be None.
 
+    Results are cached per connection string (without its password); a fresh
+    copy is returned on every call so callers are free to modify it.
+
     See https://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-CONNSTRING
 
     :param str conn_str: a libpq-compliant connection string
@@ -191,6 +203,11 @@ def get_conn_info_dict(conn_str):
     :rtype:              dict
     """  # noqa
 
+    key = _PASSWORD_RE.sub('', conn_str)
+    cached = _conn_info_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+
     result = {'user': None, 'host': None, 'port': None, 'dbname': None,
               'search_path': None}
 
@@ -211,7 +228,10 @@ def get_conn_info_dict(conn_str):
     if search_path_match:
         result['search_path'] = search_path_match.group(1)
 
-    return result
+    if len(_conn_info_cache) >= _CONN_INFO_CACHE_SIZE:
+        _conn_info_cache.clear()
+    _conn_info_cache[key] = result
+    return dict(result)
 
 
 def combine_dicts(*args):
@@ -37,9 +37,7 @@ class VocabularyAddIndexTransform(Transform):
             if table_name not in VOCAB_TABLES:
                 continue
 
-            new_indexs = cls.modify_table(metadata, table)
-            if len(new_indexs) > 0:
-                indexes.extend(cls.modify_table(metadata, table))
+            indexes.extend(cls.modify_table(metadata, table))
 
         return indexes
 
@@ -32,9 +32,7 @@ class VocabularyDropIndexTransform(Transform):
             if table_name not in VOCAB_TABLES:
                 continue
 
-            new_indexs = cls.modify_table(metadata, table)
-            if len(new_indexs) > 0:
-                indexes.extend(cls.modify_table(metadata, table))
+            indexes.extend(cls.modify_table(metadata, table))
 
         return indexes
 